@@ -0,0 +1,96 @@
+# Потоковая передача больших файлов с постоянным расходом памяти. Клиент
+# шлёт заголовок (операция и длина) и сам файл через socket.sendfile;
+# сервер либо пишет поток на диск (SINK) и отвечает числом сохранённых
+# байт, либо возвращает его клиенту (ECHO). Данные перекладываются через
+# канал (pipe) вызовом os.splice и не копируются в память процесса; без
+# os.splice (не Linux) - через один буфер фиксированного размера.
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+BULK_HEADER = struct.Struct('!cQ')
+BULK_RESULT = struct.Struct('!Q')
+SINK = b'S'
+ECHO = b'E'
+CHUNK_SIZE = 1024 * 1024
+# Linux: размер канала, по умолчанию 64 КБ
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+
+def recv_exactly(sock, size):
+    # None - соединение закрыто до первого байта, как у FrameReader
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if not data:
+                return None
+            raise ConnectionResetError("Connection closed in the middle " +
+                                       "of a bulk header")
+        data += chunk
+    return bytes(data)
+
+
+def open_pipe(size):
+    read_end, write_end = os.pipe()
+    try:
+        fcntl.fcntl(write_end, F_SETPIPE_SZ, size)
+    except OSError:
+        pass  # Больше /proc/sys/fs/pipe-max-size - остаётся 64 КБ
+    return read_end, write_end
+
+
+def splice_stream(sock, size, target_fd, chunk_size=CHUNK_SIZE):
+    # Сокет -> канал -> файл или обратно в сокет, без копирования в
+    # пространство пользователя
+    source = sock.fileno()
+    read_end, write_end = open_pipe(chunk_size)
+    moved = 0
+    try:
+        while moved < size:
+            chunk = os.splice(source, write_end,
+                              min(chunk_size, size - moved),
+                              flags=os.SPLICE_F_MOVE)
+            if not chunk:
+                break
+            moved += chunk
+            while chunk:
+                chunk -= os.splice(read_end, target_fd, chunk,
+                                   flags=os.SPLICE_F_MOVE)
+    finally:
+        os.close(read_end)
+        os.close(write_end)
+    return moved
+
+
+def copy_stream(sock, size, target=None, chunk_size=CHUNK_SIZE):
+    buffer = memoryview(bytearray(chunk_size))
+    moved = 0
+    while moved < size:
+        chunk = sock.recv_into(buffer, min(chunk_size, size - moved))
+        if not chunk:
+            break
+        if target is None:
+            sock.sendall(buffer[:chunk])
+        else:
+            target.write(buffer[:chunk])
+        moved += chunk
+    return moved
+
+
+def pump(sock, size, target=None, chunk_size=CHUNK_SIZE):
+    # Перекладывает до size байт из сокета в файл target (None - обратно
+    # в сокет) и возвращает их число; меньше size - собеседник закрыл
+    # соединение раньше
+    if hasattr(os, 'splice'):
+        target_fd = sock.fileno() if target is None else target.fileno()
+        return splice_stream(sock, size, target_fd, chunk_size)
+    return copy_stream(sock, size, target, chunk_size)
+
+
+def throughput(size, seconds):
+    return f"{size / seconds / 1e6 if seconds else 0.0:.1f} MB/s"
@@ -1,7 +1,17 @@
 import argparse
+from collections import deque
+from contextlib import contextmanager
+import os
 import socket
+import threading
+import time
 from loguru import logger
 import sys
+from tcp_framing import FrameError, FrameReader, MAX_FRAME_SIZE, send_frame
+from tcp_compression import (CODECS, LEVELS, CompressionOptions, agreed,
+                             invalid_level)
+from tcp_bulk import (BULK_HEADER, BULK_RESULT, ECHO, SINK, pump,
+                      recv_exactly, throughput)
 
 
 def parse_args():
@@ -10,15 +20,72 @@ def parse_args():
                         help='Server IP address (default: 127.0.0.1)')
     parser.add_argument('--port', type=int, default=5000,
                         help='Server port (default: 5000)')
-    parser.add_argument('--message', type=str, required=True,
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--message', type=str,
                         help='Message to send')
+    source.add_argument('--input', type=str,
+                        help='File with one message per line to send over ' +
+                        'one connection, "-" for stdin (framed protocol only)')
+    source.add_argument('--file', type=str,
+                        help='File to stream with socket.sendfile (bulk ' +
+                        'protocol only)')
     parser.add_argument('--log', type=str,
                         default='1_Presentation/2_Practice/1_implementation_' +
                         'of_TCP_client_and_TCP_server/client.log',
                         help='Log file path (default: 1_Presentation/2_Pract' +
                         'ice/1_implementation_of_TCP_client_and_TCP_server/c' +
                         'lient.log)')
-    return parser.parse_args()
+    parser.add_argument('--protocol', choices=['raw', 'framed', 'bulk'],
+                        default='raw',
+                        help='Wire protocol: one recv per message, ' +
+                        'length-prefixed frames or one streamed file per ' +
+                        'connection (default: raw)')
+    parser.add_argument('--echo', action='store_true',
+                        help='Ask the server to stream --file back instead ' +
+                        'of storing it')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Where to write the echoed file (default: ' +
+                        'discard it)')
+    parser.add_argument('--max-frame-size', type=int, default=MAX_FRAME_SIZE,
+                        help='Max frame payload in bytes for framed ' +
+                        f'protocol (default: {MAX_FRAME_SIZE})')
+    parser.add_argument('--window', type=int, default=32,
+                        help='Max requests in flight with --input ' +
+                        '(default: 32)')
+    parser.add_argument('--compression', type=str, default=None,
+                        help='Offer these codecs to the server in order of ' +
+                        'preference, comma separated, framed protocol only ' +
+                        f'({", ".join(CODECS)}; default: disabled)')
+    parser.add_argument('--compress-level', type=int, default=None,
+                        help='Compression level: zlib -1-9, lzma 0-9, bz2 ' +
+                        '1-9 (default: codec default)')
+    parser.add_argument('--compress-threshold', type=int, default=1024,
+                        help='Compress messages of at least N bytes ' +
+                        '(default: 1024)')
+    parser.add_argument('--unix', type=str, default=None,
+                        help='Connect to the server Unix socket at this ' +
+                        'path instead of --host/--port')
+    args = parser.parse_args()
+    if args.unix and not hasattr(socket, 'AF_UNIX'):
+        parser.error('--unix requires Unix domain sockets')
+    if args.input and args.protocol != 'framed':
+        parser.error('--input requires --protocol framed')
+    if (args.file is None) != (args.protocol != 'bulk'):
+        parser.error('--file and --protocol bulk go together')
+    if args.output and not args.echo:
+        parser.error('--output requires --echo')
+    if args.compression:
+        if args.protocol != 'framed':
+            parser.error('--compression requires --protocol framed')
+        unknown = set(args.compression.split(',')) - set(CODECS)
+        if unknown:
+            parser.error(f'unsupported codecs: {", ".join(sorted(unknown))}')
+        for name in invalid_level(args.compression.split(','),
+                                  args.compress_level):
+            levels = LEVELS[name]
+            parser.error(f'--compress-level for {name} must be between ' +
+                         f'{levels[0]} and {levels[-1]}')
+    return args
 
 
 def setup_logging(log_file):
@@ -29,11 +96,65 @@ def setup_logging(log_file):
     return logger
 
 
-def run_client(host, port, message, log):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
+def negotiate_compression(client_socket, reader, options, log,
+                          max_frame_size=MAX_FRAME_SIZE):
+    send_frame(client_socket, options.hello(), max_frame_size)
+    reply = reader.read_frame()
+    if reply is None:
+        raise ConnectionResetError("Server closed connection during " +
+                                   "compression negotiation")
+    codec = agreed(options, reply, max_frame_size)
+    log.info("Compression: " +
+             (codec.codec if codec else "not supported by server"))
+    return codec
+
+
+def send_message(client_socket, payload, codec=None,
+                 max_frame_size=MAX_FRAME_SIZE):
+    if codec is None:
+        send_frame(client_socket, payload, max_frame_size)
+    else:
+        prefix, body = codec.encode(payload)
+        send_frame(client_socket, body, max_frame_size, prefix)
+
+
+def server_address(host, port, unix=None):
+    # (семейство, адрес, имя для логов): TCP или Unix-сокет того же сервера
+    if unix:
+        return socket.AF_UNIX, unix, f"unix:{unix}"
+    return socket.AF_INET, (host, port), f"{host}:{port}"
+
+
+def run_client(host, port, message, log, protocol='raw',
+               max_frame_size=MAX_FRAME_SIZE, compression=None, unix=None):
+    family, address, name = server_address(host, port, unix)
+    with socket.socket(family, socket.SOCK_STREAM) as client_socket:
         try:
-            client_socket.connect((host, port))
-            log.info(f"Connected to server {host}:{port}")
+            client_socket.connect(address)
+            log.info(f"Connected to server {name}")
+
+            if protocol == 'framed':
+                reader = FrameReader(client_socket, max_frame_size)
+                codec = None
+                if compression is not None:
+                    codec = negotiate_compression(client_socket, reader,
+                                                  compression, log,
+                                                  max_frame_size)
+                send_message(client_socket, message.encode('utf-8'), codec,
+                             max_frame_size)
+                log.debug(f"Sent message: {message}")
+
+                # Ответ приходит целиком, независимо от размера
+                response = reader.read_frame()
+                if response is None:
+                    log.error("Server closed connection without response")
+                    return
+                if codec is not None:
+                    response = codec.decode(response)
+                log.info(f"Server response: {str(response, 'utf-8')}")
+                if codec is not None:
+                    log.info(f"Compression {codec.summary()}")
+                return
 
             # Отправка сообщения
             client_socket.sendall(message.encode('utf-8'))
@@ -43,13 +164,431 @@ def run_client(host, port, message, log):
             response = client_socket.recv(1024)
             log.info(f"Server response: {response.decode('utf-8')}")
 
-        except ConnectionRefusedError:
+        except (ConnectionRefusedError, FileNotFoundError):
             log.error("Server is not available")
         except Exception as e:
             log.error(f"Connection error: {str(e)}")
 
 
+def send_pipelined(client_socket, messages, window, pending, log,
+                   max_frame_size=MAX_FRAME_SIZE, codec=None, stopped=None):
+    try:
+        for message in messages:
+            # Не больше window запросов без ответа
+            window.acquire()
+            if stopped is not None and stopped.is_set():
+                break  # Ответов больше не будет
+            payload = message.encode('utf-8')
+            pending.append((payload, time.perf_counter()))
+            send_message(client_socket, payload, codec, max_frame_size)
+    except Exception as e:
+        log.error(f"Send error: {e}")
+    finally:
+        # Сервер увидит конец потока, ответит на оставшиеся запросы и
+        # закроет соединение
+        try:
+            client_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+def run_pipelined_client(host, port, messages, log, window=32,
+                         max_frame_size=MAX_FRAME_SIZE, compression=None,
+                         unix=None):
+    family, address, name = server_address(host, port, unix)
+    with socket.socket(family, socket.SOCK_STREAM) as client_socket:
+        try:
+            client_socket.connect(address)
+        except (ConnectionRefusedError, FileNotFoundError):
+            log.error("Server is not available")
+            return
+        log.info(f"Connected to server {name}, window {window}")
+
+        reader = FrameReader(client_socket, max_frame_size)
+        codec = None
+        if compression is not None:
+            try:
+                codec = negotiate_compression(client_socket, reader,
+                                              compression, log,
+                                              max_frame_size)
+            except (ConnectionError, FrameError) as e:
+                log.error(f"Connection error: {e}")
+                return
+
+        # Сжатие и распаковка идут в разных потоках, но у каждого
+        # направления свой объект (см. tcp_compression.Compression)
+        slots = threading.Semaphore(window)
+        pending = deque()
+        stopped = threading.Event()
+        sender = threading.Thread(target=send_pipelined,
+                                  args=(client_socket, messages, slots,
+                                        pending, log, max_frame_size, codec,
+                                        stopped),
+                                  daemon=True)
+        completed = mismatched = 0
+        total_latency = 0.0
+        started = time.perf_counter()
+        sender.start()
+        try:
+            while True:
+                response = reader.read_frame()
+                if response is None:
+                    break
+                if codec is not None:
+                    response = codec.decode(response)
+                # Сервер отвечает строго по порядку, поэтому ответ
+                # относится к самому старому запросу без ответа
+                payload, sent_at = pending.popleft()
+                slots.release()
+                total_latency += time.perf_counter() - sent_at
+                completed += 1
+                if response[:6] != b'ECHO: ' or response[6:] != payload:
+                    mismatched += 1
+                    log.warning("Unexpected response to request " +
+                                f"{completed}")
+                log.debug(f"Server response: {str(response, 'utf-8')}")
+        except Exception as e:
+            log.error(f"Connection error: {e}")
+        finally:
+            # Приём закончен: отправитель может ждать свободного
+            # места в окне, которое уже не освободится, или в sendall
+            stopped.set()
+            slots.release(window)
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        sender.join()
+
+        elapsed = time.perf_counter() - started
+        if pending:
+            log.error(f"{len(pending)} requests left without response")
+        if completed:
+            log.info(f"Completed {completed} requests in {elapsed:.3f}s: " +
+                     f"{completed / elapsed:.1f} req/s, avg latency " +
+                     f"{total_latency / completed * 1000:.3f} ms, " +
+                     f"{mismatched} mismatched")
+        if codec is not None:
+            log.info(f"Compression {codec.summary()}")
+
+
+class PooledConnection:
+    def __init__(self, host, port, connect_timeout=5.0,
+                 max_frame_size=MAX_FRAME_SIZE, unix=None):
+        family, address, _ = server_address(host, port, unix)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self.socket.settimeout(connect_timeout)
+            self.socket.connect(address)
+        except OSError:
+            self.socket.close()
+            raise
+        self.socket.settimeout(None)
+        if family != socket.AF_UNIX:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = FrameReader(self.socket, max_frame_size)
+        self.max_frame_size = max_frame_size
+        self.last_used = time.monotonic()
+
+    def request(self, payload):
+        send_frame(self.socket, payload, self.max_frame_size)
+        response = self.reader.read_frame()
+        if response is None:
+            raise ConnectionResetError("Server closed the connection")
+        self.last_used = time.monotonic()
+        return bytes(response)
+
+    def is_closed(self):
+        # Неблокирующий peek: пустой ответ означает, что сервер закрыл
+        # соединение, пока оно лежало в пуле
+        try:
+            self.socket.setblocking(False)
+            return self.socket.recv(1, socket.MSG_PEEK) == b''
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+        finally:
+            self.socket.setblocking(True)
+
+    def close(self):
+        self.socket.close()
+
+
+def echo_probe(connection):
+    return connection.request(b'') == b'ECHO: '
+
+
+class ConnectionPool:
+    # Потокобезопасный пул постоянных соединений (framed протокол).
+    # probe - необязательная проверка живости соединения при выдаче,
+    # например echo_probe. unix - путь Unix-сокета вместо host:port.
+    # Вместо выброшенных соединений пул открывает новые до min_size.
+
+    def __init__(self, host, port, log, min_size=1, max_size=10,
+                 idle_timeout=60.0, probe=None, connect_timeout=5.0,
+                 max_frame_size=MAX_FRAME_SIZE, unix=None):
+        if not 0 <= min_size <= max_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min <= max")
+        self.host = host
+        self.port = port
+        self.unix = unix
+        self.name = server_address(host, port, unix)[2]
+        self.log = log
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.probe = probe
+        self.connect_timeout = connect_timeout
+        self.max_frame_size = max_frame_size
+        self.idle = deque()
+        self.size = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self._refill()
+
+    def _connect(self):
+        connection = PooledConnection(self.host, self.port,
+                                      self.connect_timeout,
+                                      self.max_frame_size, self.unix)
+        self.log.debug(f"Pool opened connection to {self.name}")
+        return connection
+
+    def _refill(self):
+        # Место под соединение занимается под блокировкой, а подключение -
+        # вне её, чтобы не держать остальные потоки
+        while True:
+            with self.condition:
+                if self.closed or self.size >= self.min_size:
+                    return
+                self.size += 1
+            try:
+                connection = self._connect()
+            except OSError as e:
+                self.log.warning(f"Pool refill failed: {e}")
+                self._discard()
+                return
+            with self.condition:
+                if self.closed:
+                    self.size -= 1
+                else:
+                    self.idle.append(connection)
+                    self.condition.notify()
+                    connection = None
+            if connection is not None:
+                connection.close()
+
+    def _evict_idle(self):
+        # Вызывается под self.condition; старые соединения лежат в начале
+        evicted = []
+        deadline = time.monotonic() - self.idle_timeout
+        while (self.idle and self.size > self.min_size
+               and self.idle[0].last_used < deadline):
+            evicted.append(self.idle.popleft())
+            self.size -= 1
+        return evicted
+
+    def _is_alive(self, connection):
+        if connection.is_closed():
+            return False
+        if self.probe is None:
+            return True
+        try:
+            return self.probe(connection)
+        except (OSError, FrameError):
+            return False
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.condition:
+                if self.closed:
+                    raise RuntimeError("Connection pool is closed")
+                evicted = self._evict_idle()
+                connection = None
+                if self.idle:
+                    # LIFO: самое "тёплое" соединение
+                    connection = self.idle.pop()
+                elif self.size < self.max_size:
+                    self.size += 1
+                else:
+                    remaining = (None if deadline is None
+                                 else deadline - time.monotonic())
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError("No free connection in the pool")
+                    self.condition.wait(remaining)
+                    continue
+
+            for stale in evicted:
+                stale.close()
+            if connection is None:
+                try:
+                    return self._connect()
+                except OSError:
+                    self._discard()
+                    raise
+            if self._is_alive(connection):
+                return connection
+            self.log.debug("Pool dropped dead connection")
+            connection.close()
+            self._discard()
+            self._refill()
+
+    def _discard(self):
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    def release(self, connection, broken=False):
+        if broken or self.closed:
+            connection.close()
+            self._discard()
+            self._refill()
+            return
+        with self.condition:
+            connection.last_used = time.monotonic()
+            self.idle.append(connection)
+            evicted = self._evict_idle()
+            self.condition.notify()
+        for stale in evicted:
+            stale.close()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        except BaseException:
+            self.release(connection, broken=True)
+            raise
+        self.release(connection)
+
+    def request(self, message, timeout=None):
+        # Одна повторная попытка на новом соединении, если старое
+        # оборвалось (broken pipe, reset)
+        for attempt in (1, 2):
+            connection = self.acquire(timeout)
+            try:
+                response = connection.request(message.encode('utf-8'))
+            except (ConnectionError, FrameError) as e:
+                self.release(connection, broken=True)
+                if attempt == 2:
+                    raise
+                self.log.warning(f"Pooled connection broken ({e}), " +
+                                 "reconnecting")
+                continue
+            except BaseException:
+                self.release(connection, broken=True)
+                raise
+            self.release(connection)
+            return response.decode('utf-8')
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, deque()
+            self.size -= len(idle)
+            self.condition.notify_all()
+        for connection in idle:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def receive_echo(client_socket, size, output, result):
+    try:
+        with open(output or os.devnull, 'wb') as target:
+            result['received'] = pump(client_socket, size, target)
+        result['finished'] = time.perf_counter()
+    except OSError as e:
+        result['error'] = e
+
+
+def run_bulk_client(host, port, path, log, echo=False, output=None,
+                    unix=None):
+    # Файл уходит через socket.sendfile (sendfile(2) без копирования в
+    # память процесса), эхо читается параллельно в отдельном потоке
+    size = os.path.getsize(path)
+    family, address, name = server_address(host, port, unix)
+    with socket.socket(family, socket.SOCK_STREAM) as client_socket, \
+            open(path, 'rb') as source:
+        try:
+            client_socket.connect(address)
+        except (ConnectionRefusedError, FileNotFoundError):
+            log.error("Server is not available")
+            return
+        log.info(f"Connected to server {name}, streaming {size} bytes " +
+                 f"from {path}" + (" for echo" if echo else ""))
+
+        result = {}
+        receiver = None
+        try:
+            started = time.perf_counter()
+            client_socket.sendall(BULK_HEADER.pack(ECHO if echo else SINK,
+                                                   size))
+            if echo:
+                receiver = threading.Thread(target=receive_echo,
+                                            args=(client_socket, size,
+                                                  output, result),
+                                            daemon=True)
+                receiver.start()
+            sent = client_socket.sendfile(source)
+            elapsed = time.perf_counter() - started
+            log.info(f"Sent {sent} bytes in {elapsed:.3f}s, " +
+                     throughput(sent, elapsed))
+
+            if echo:
+                receiver.join()
+                if 'error' in result:
+                    raise result['error']
+                received = result['received']
+                elapsed = result['finished'] - started
+                log.info(f"Received {received} echoed bytes in " +
+                         f"{elapsed:.3f}s, {throughput(received, elapsed)}" +
+                         (f", written to {output}" if output else ""))
+            else:
+                reply = recv_exactly(client_socket, BULK_RESULT.size)
+                if reply is None:
+                    log.error("Server closed connection without response")
+                    return
+                received = BULK_RESULT.unpack(reply)[0]
+                elapsed = time.perf_counter() - started
+                log.info(f"Server stored {received} bytes, " +
+                         f"{throughput(received, elapsed)} end to end")
+            if received != size:
+                log.error(f"Transfer incomplete: {received} of {size} bytes")
+        except Exception as e:
+            log.error(f"Connection error: {e}")
+
+
+def read_messages(path):
+    stream = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    with stream:
+        for line in stream:
+            line = line.rstrip('\r\n')
+            if line:
+                yield line
+
+
 if __name__ == '__main__':
     args = parse_args()
     log = setup_logging(args.log)
-    run_client(args.host, args.port, args.message, log)
+    compression = None
+    if args.compression:
+        compression = CompressionOptions(args.compression.split(','),
+                                         args.compress_level,
+                                         args.compress_threshold)
+    if args.file:
+        run_bulk_client(args.host, args.port, args.file, log, args.echo,
+                        args.output, args.unix)
+    elif args.input:
+        run_pipelined_client(args.host, args.port, read_messages(args.input),
+                             log, args.window, args.max_frame_size,
+                             compression, args.unix)
+    else:
+        run_client(args.host, args.port, args.message, log, args.protocol,
+                   args.max_frame_size, compression, args.unix)
@@ -0,0 +1,182 @@
+# Сжатие кадров для framed протокола, включается по согласованию.
+# Клиент первым кадром отправляет HELLO со списком кодеков, сервер
+# отвечает HELLO с выбранным кодеком (или пустым, если общих нет).
+# Старый сервер просто вернёт эхо, и клиент продолжит без сжатия.
+# После согласования каждый кадр начинается с байта-флага: PLAIN или
+# COMPRESSED. Сжимаются только сообщения от threshold байт.
+import time
+import zlib
+
+from tcp_framing import FrameError, MAX_FRAME_SIZE
+
+try:
+    import lzma
+except ImportError:  # Python, собранный без liblzma
+    lzma = None
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+HELLO = b'\x00COMPRESS '
+PLAIN = b'\x00'
+COMPRESSED = b'\x01'
+
+CODECS = tuple(name for name, module in (('zlib', zlib), ('lzma', lzma),
+                                         ('bz2', bz2)) if module is not None)
+# Допустимые уровни сжатия; zlib -1 - уровень по умолчанию
+LEVELS = {'zlib': range(-1, 10), 'lzma': range(0, 10), 'bz2': range(1, 10)}
+
+
+def invalid_level(codecs, level):
+    # Кодеки, для которых level вне допустимого диапазона
+    if level is None:
+        return []
+    return [name for name in codecs if level not in LEVELS[name]]
+
+
+class CompressionOptions:
+    # codecs - допустимые кодеки в порядке предпочтения; level - уровень
+    # сжатия (None - по умолчанию для кодека)
+
+    def __init__(self, codecs=('zlib',), level=None, threshold=1024):
+        unsupported = [name for name in codecs if name not in CODECS]
+        if unsupported:
+            raise ValueError("Unsupported compression codecs: " +
+                             ", ".join(unsupported))
+        invalid = invalid_level(codecs, level)
+        if invalid:
+            raise ValueError(f"Compression level {level} is out of range " +
+                             "for " + ", ".join(invalid))
+        self.codecs = tuple(codecs)
+        self.level = level
+        self.threshold = threshold
+
+    def hello(self):
+        return HELLO + ','.join(self.codecs).encode('ascii')
+
+    def choose(self, hello):
+        # Первый кодек клиента, который разрешён и на сервере
+        offered = bytes(hello[len(HELLO):]).decode('ascii', 'replace')
+        for name in offered.split(','):
+            if name in self.codecs:
+                return name
+        return None
+
+
+def is_hello(payload):
+    return payload[:len(HELLO)] == HELLO
+
+
+class Compression:
+    # Состояние сжатия одного соединения. Для zlib на каждое направление
+    # один поток deflate на всё соединение: после сообщения делается
+    # Z_SYNC_FLUSH, и словарь переносится на следующие сообщения. lzma и
+    # bz2 не умеют сбрасывать поток на середине, поэтому сжимают каждое
+    # сообщение отдельно.
+    # Отправка и приём используют разные объекты, так что их можно вести
+    # из разных потоков.
+
+    def __init__(self, codec, level=None, threshold=1024,
+                 max_size=MAX_FRAME_SIZE):
+        self.codec = codec
+        self.level = level
+        self.threshold = threshold
+        self.max_size = max_size
+        if codec == 'zlib':
+            self.compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION if level is None else level,
+                zlib.DEFLATED, -zlib.MAX_WBITS)
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif codec == 'lzma':
+            self.filters = [{'id': lzma.FILTER_LZMA2,
+                             'preset': 6 if level is None else level}]
+        # Счётчики: байты до и после сжатия и процессорное время, нс
+        self.raw_sent = self.wire_sent = self.compress_ns = 0
+        self.raw_received = self.wire_received = self.decompress_ns = 0
+
+    def encode(self, payload, prefix=b''):
+        # Возвращает (заголовок, тело) кадра; несжатое тело - это сам
+        # payload без копирования
+        size = len(prefix) + len(payload)
+        if size < self.threshold:
+            return PLAIN + prefix, payload
+        started = time.thread_time_ns()
+        if self.codec == 'zlib':
+            data = (self.compressor.compress(prefix) +
+                    self.compressor.compress(payload) +
+                    self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        elif self.codec == 'lzma':
+            data = lzma.compress(prefix + payload, lzma.FORMAT_RAW,
+                                 filters=self.filters)
+        else:
+            data = bz2.compress(prefix + payload,
+                                9 if self.level is None else self.level)
+        self.compress_ns += time.thread_time_ns() - started
+        self.raw_sent += size
+        self.wire_sent += len(data)
+        return COMPRESSED, data
+
+    def decode(self, frame):
+        if not frame:
+            raise FrameError("Frame without compression flag")
+        flag, data = frame[:1], frame[1:]
+        if flag == PLAIN:
+            return data
+        if flag != COMPRESSED:
+            raise FrameError(f"Unknown compression flag {flag[0]}")
+
+        # Размер распакованного сообщения ограничен так же, как кадр
+        started = time.thread_time_ns()
+        if self.codec == 'zlib':
+            decompressor = self.decompressor
+        elif self.codec == 'lzma':
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW,
+                                                 filters=self.filters)
+        else:
+            decompressor = bz2.BZ2Decompressor()
+        try:
+            payload = decompressor.decompress(data, self.max_size + 1)
+        except (zlib.error, EOFError, OSError) as e:
+            raise FrameError(f"Corrupt compressed frame: {e}")
+        if (len(payload) > self.max_size or
+                getattr(decompressor, 'unconsumed_tail', b'')):
+            raise FrameError("Decompressed frame exceeds limit of " +
+                             f"{self.max_size} bytes")
+        self.decompress_ns += time.thread_time_ns() - started
+        self.raw_received += len(payload)
+        self.wire_received += len(data)
+        return payload
+
+    def summary(self):
+        parts = []
+        for direction, raw, wire, cpu_ns in (
+                ('sent', self.raw_sent, self.wire_sent, self.compress_ns),
+                ('received', self.raw_received, self.wire_received,
+                 self.decompress_ns)):
+            if raw:
+                parts.append(f"{direction} {raw} bytes as {wire} " +
+                             f"(ratio {raw / max(wire, 1):.2f}x, " +
+                             f"{cpu_ns / 1e6:.1f} ms CPU, " +
+                             f"{raw / max(cpu_ns, 1) * 1000:.1f} MB/s)")
+        return f"{self.codec}: " + ("; ".join(parts) or "nothing compressed")
+
+
+def accept(options, hello, max_size=MAX_FRAME_SIZE):
+    # Сервер: (состояние сжатия или None, ответный кадр)
+    codec = options.choose(hello)
+    reply = HELLO + (codec or '').encode('ascii')
+    if codec is None:
+        return None, reply
+    return Compression(codec, options.level, options.threshold,
+                       max_size), reply
+
+
+def agreed(options, reply, max_size=MAX_FRAME_SIZE):
+    # Клиент: ответ на HELLO. Эхо вместо HELLO - сервер без сжатия
+    if not is_hello(reply):
+        return None
+    codec = bytes(reply[len(HELLO):]).decode('ascii', 'replace')
+    if codec not in options.codecs:
+        return None
+    return Compression(codec, options.level, options.threshold, max_size)
@@ -0,0 +1,178 @@
+# Протокол с длиной кадра: 4 байта длины (big-endian) + полезная нагрузка.
+# Общий для tcp_server.py и tcp_client.py, сохраняет границы сообщений
+# при любом размере и при склеивании нескольких сообщений в один recv.
+import asyncio
+import socket
+import struct
+import sys
+import time
+
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+BUFFER_SIZE = 64 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+def encode_header(length, max_frame_size=MAX_FRAME_SIZE):
+    if length > max_frame_size:
+        raise FrameError(f"Frame of {length} bytes exceeds limit of " +
+                         f"{max_frame_size} bytes")
+    return HEADER.pack(length)
+
+
+def send_buffers(sock, buffers):
+    if not hasattr(sock, 'sendmsg'):  # Windows
+        sock.sendall(b''.join(buffers))
+        return
+
+    # Несколько буферов уходят одним системным вызовом (scatter/gather)
+    # без склейки в новый bytes; при частичной отправке досылаем остаток
+    buffers = list(buffers)
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+
+def send_frame(sock, payload, max_frame_size=MAX_FRAME_SIZE, prefix=b''):
+    header = encode_header(len(prefix) + len(payload), max_frame_size)
+    send_buffers(sock, [header, prefix, payload])
+
+
+def set_socket_timeout(sock, option, timeout):
+    # SO_RCVTIMEO или SO_SNDTIMEO в секундах, 0 - без ограничения
+    if sys.platform == 'win32':
+        value = struct.pack('I', int(timeout * 1000))
+    else:
+        seconds = int(timeout)
+        value = struct.pack('ll', seconds, int((timeout - seconds) * 1000000))
+    sock.setsockopt(socket.SOL_SOCKET, option, value)
+
+
+class FrameReader:
+    # Читает кадры через recv_into в один переиспользуемый буфер.
+    # read_frame() возвращает memoryview на буфер, которая действительна
+    # только до следующего вызова read_frame(). Начатый кадр должен прийти
+    # целиком за read_timeout секунд. Если вызывающий задал сокету
+    # SO_RCVTIMEO (idle_timeout), то, пока кадр не дочитан, recv ждёт не
+    # дольше, чем осталось до срока кадра, а после кадра таймаут
+    # возвращается к idle_timeout.
+
+    def __init__(self, sock, max_frame_size=MAX_FRAME_SIZE,
+                 buffer_size=BUFFER_SIZE, read_timeout=None,
+                 idle_timeout=None):
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.deadline = None
+        self.narrowed = False
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def read_frame(self):
+        needed = HEADER.size
+        while True:
+            available = self.end - self.start
+            if available >= HEADER.size:
+                (length,) = HEADER.unpack_from(self.buffer, self.start)
+                if length > self.max_frame_size:
+                    raise FrameError(f"Frame of {length} bytes exceeds " +
+                                     f"limit of {self.max_frame_size} bytes")
+                needed = HEADER.size + length
+                if available >= needed:
+                    payload = self.view[self.start + HEADER.size:
+                                        self.start + needed]
+                    self.start += needed
+                    self.deadline = None
+                    if self.narrowed:
+                        set_socket_timeout(self.sock, socket.SO_RCVTIMEO,
+                                           self.idle_timeout)
+                        self.narrowed = False
+                    return payload
+
+            if self.read_timeout and self.end > self.start:
+                now = time.monotonic()
+                if self.deadline is None:
+                    self.deadline = now + self.read_timeout
+                left = self.deadline - now
+                if left <= 0:
+                    raise self._expired()
+                if self.idle_timeout is not None:
+                    # Не меньше 1 мс: нулевой SO_RCVTIMEO - без ограничения
+                    set_socket_timeout(self.sock, socket.SO_RCVTIMEO,
+                                       max(left, 0.001))
+                    self.narrowed = True
+            self._reserve(needed)
+            try:
+                received = self.sock.recv_into(self.view[self.end:])
+            except BlockingIOError:
+                if self.narrowed:
+                    raise self._expired()
+                raise
+            if not received:
+                if self.end > self.start:
+                    raise FrameError("Connection closed in the middle of " +
+                                     "a frame")
+                return None
+            self.end += received
+
+    def _expired(self):
+        return TimeoutError("frame not received within " +
+                            f"{self.read_timeout:g}s")
+
+    def _reserve(self, needed):
+        available = self.end - self.start
+        if not available:
+            self.start = self.end = 0
+        if self.start + needed <= len(self.buffer):
+            return
+
+        if needed > len(self.buffer):
+            size = min(max(needed, 2 * len(self.buffer)),
+                       HEADER.size + self.max_frame_size)
+            buffer = bytearray(size)
+            buffer[:available] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            # Сдвиг непрочитанного хвоста в начало буфера
+            self.view[:available] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = available
+
+
+async def read_frame_async(reader, max_frame_size=MAX_FRAME_SIZE,
+                           on_header=None):
+    # on_header(length) вызывается до чтения тела кадра, например чтобы
+    # зарезервировать под него память
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise FrameError("Connection closed in the middle of a frame")
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > max_frame_size:
+        raise FrameError(f"Frame of {length} bytes exceeds limit of " +
+                         f"{max_frame_size} bytes")
+    if on_header is not None:
+        await on_header(length)
+    try:
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise FrameError("Connection closed in the middle of a frame")
+
+
+def write_frame_async(writer, payload, max_frame_size=MAX_FRAME_SIZE,
+                      prefix=b''):
+    writer.writelines([encode_header(len(prefix) + len(payload),
+                                     max_frame_size), prefix, payload])
@@ -0,0 +1,131 @@
+# Ограничения на соединение для tcp_server.py: таймауты простоя, чтения
+# кадра и записи ответа, предел исходящего буфера и общий для всех
+# соединений бюджет памяти под кадры. Клиент, который не шлёт данные или
+# не читает ответы, отключается и не держит сервер.
+import asyncio
+import socket
+import time
+
+from tcp_framing import FrameError, set_socket_timeout
+
+IDLE, READING, WRITING = 'idle', 'reading', 'writing'
+
+
+class ConnectionLimits:
+    # Таймауты в секундах (0 - без ограничения), размеры в байтах
+
+    def __init__(self, idle_timeout=60.0, read_timeout=30.0,
+                 write_timeout=30.0, max_outbound=1024 * 1024,
+                 memory_budget=256 * 1024 * 1024):
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.max_outbound = max_outbound
+        self.memory_budget = memory_budget
+
+    def timeout(self, stage):
+        return {IDLE: self.idle_timeout, READING: self.read_timeout,
+                WRITING: self.write_timeout}[stage]
+
+    def reason(self, stage):
+        timeout = self.timeout(stage)
+        if stage == IDLE:
+            return f"no data for {timeout:g}s"
+        if stage == READING:
+            return f"frame not received within {timeout:g}s"
+        return f"slow consumer, response not read within {timeout:g}s"
+
+
+def set_socket_timeouts(sock, read_timeout, write_timeout):
+    # Таймауты ядра (SO_RCVTIMEO/SO_SNDTIMEO): сокет остаётся блокирующим,
+    # на каждое сообщение не тратится лишних системных вызовов. По
+    # истечении recv/send завершаются с BlockingIOError
+    set_socket_timeout(sock, socket.SO_RCVTIMEO, read_timeout)
+    set_socket_timeout(sock, socket.SO_SNDTIMEO, write_timeout)
+
+
+class MemoryBudget:
+    # Сколько байт кадров одновременно держат все соединения. Соединение,
+    # которому не хватило бюджета, ждёт освобождения не дольше timeout
+
+    def __init__(self, limit, timeout=None):
+        self.limit = limit
+        self.timeout = timeout or None
+        self.used = 0
+        self.waiting = 0
+        self.changed = asyncio.Condition()
+
+    async def acquire(self, size):
+        if size > self.limit:
+            raise FrameError(f"Frame of {size} bytes exceeds memory budget " +
+                             f"of {self.limit} bytes")
+        if self.used + size > self.limit:
+            self.waiting += 1
+            try:
+                async with self.changed:
+                    await asyncio.wait_for(self.changed.wait_for(
+                        lambda: self.used + size <= self.limit),
+                        self.timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("memory budget exhausted for " +
+                                   f"{self.timeout:g}s")
+            finally:
+                self.waiting -= 1
+        self.used += size
+
+    async def release(self, size):
+        self.used -= size
+        if self.waiting:
+            async with self.changed:
+                self.changed.notify_all()
+
+
+class Connection:
+    # Обработчик отмечает только смену стадии, сроки проверяет
+    # evict_stalled раз в секунду - на горячем пути нет таймеров
+
+    __slots__ = ('addr', 'transport', 'budget', 'stage', 'since',
+                 'reserved', 'evicted')
+
+    def __init__(self, addr, transport, budget=None):
+        self.addr = addr
+        self.transport = transport
+        self.budget = budget
+        self.reserved = 0
+        self.evicted = None
+        self.enter(IDLE)
+
+    def enter(self, stage):
+        self.stage = stage
+        self.since = time.monotonic()
+
+    async def frame_started(self, length):
+        self.enter(READING)
+        if self.budget is not None:
+            await self.budget.acquire(length)
+            self.reserved += length
+
+    async def frame_done(self):
+        if self.reserved:
+            await self.budget.release(self.reserved)
+            self.reserved = 0
+
+    def evict(self, reason):
+        self.evicted = reason
+        self.transport.abort()
+
+
+async def evict_stalled(connections, limits, log, metrics=None,
+                        interval=1.0):
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        for connection in list(connections):
+            timeout = limits.timeout(connection.stage)
+            if (timeout and connection.evicted is None and
+                    now - connection.since > timeout):
+                reason = limits.reason(connection.stage)
+                log.warning(f"Evicting client {connection.addr}: {reason}")
+                if metrics is not None:
+                    metrics.evicted.inc()
+                connection.evict(reason)
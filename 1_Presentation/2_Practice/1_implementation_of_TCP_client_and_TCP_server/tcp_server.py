@@ -1,7 +1,40 @@
 import argparse
+import asyncio
+import os
+import select
+import signal
 import socket
+import struct
+import tempfile
+import threading
+import time
 from loguru import logger
 import sys
+from tcp_framing import (FrameError, FrameReader, HEADER, MAX_FRAME_SIZE,
+                         read_frame_async, send_buffers, send_frame,
+                         write_frame_async)
+from tcp_compression import (CODECS, LEVELS, CompressionOptions, accept,
+                             invalid_level, is_hello)
+from tcp_bulk import (BULK_HEADER, BULK_RESULT, CHUNK_SIZE, ECHO, SINK,
+                      pump, recv_exactly, throughput)
+from tcp_limits import (ConnectionLimits, Connection, IDLE, MemoryBudget,
+                        WRITING, evict_stalled, set_socket_timeouts)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'common'))
+from log_pipeline import (BackgroundWriter, LazyText,  # noqa: E402
+                          sample_messages)
+from metrics import Registry, serve_metrics  # noqa: E402
+from admission import Admission  # noqa: E402
+from profiler import MODES, StageProfiler  # noqa: E402
+from unix_socket import UnixEndpoint, unix_supported  # noqa: E402
+from capture import TrafficCapture  # noqa: E402
+from handoff import (GracefulShutdown, HandoffServer,  # noqa: E402
+                     handoff_supported, inherit_listener)
+
+# Префикс ответа кодируется один раз, ответ собирается из префикса и
+# исходного буфера без decode/encode
+ECHO_PREFIX = b'ECHO: '
 
 
 def parse_args():
@@ -16,51 +49,953 @@ def parse_args():
                         help='Log file path (default: 1_Presentation/2_Pract' +
                         'ice/1_implementation_of_TCP_client_and_TCP_server/s' +
                         'erver.log)')
-    return parser.parse_args()
+    parser.add_argument('--mode', choices=['blocking', 'async'],
+                        default='blocking',
+                        help='Server mode: one client at a time or asyncio ' +
+                        'event loop (default: blocking)')
+    parser.add_argument('--backlog', type=int, default=None,
+                        help='Listen queue size (default: 5 for blocking, ' +
+                        'SOMAXCONN for async)')
+    parser.add_argument('--max-connections', type=int, default=1000,
+                        help='Max concurrent clients in async mode ' +
+                        '(default: 1000)')
+    parser.add_argument('--protocol', choices=['raw', 'framed', 'bulk'],
+                        default='raw',
+                        help='Wire protocol: one recv per message, ' +
+                        'length-prefixed frames or one streamed file per ' +
+                        'connection (default: raw)')
+    parser.add_argument('--bulk-dir', type=str, default=None,
+                        help='Directory for files streamed with --protocol ' +
+                        'bulk (default: discard them)')
+    parser.add_argument('--max-frame-size', type=int, default=MAX_FRAME_SIZE,
+                        help='Max frame payload in bytes for framed ' +
+                        f'protocol (default: {MAX_FRAME_SIZE})')
+    parser.add_argument('--log-mode', choices=['sync', 'async'],
+                        default='sync',
+                        help='Write logs inline or from a background thread ' +
+                        '(default: sync)')
+    parser.add_argument('--log-queue', type=int, default=10000,
+                        help='Max records waiting for the background log ' +
+                        'writer, extra records are dropped (default: 10000)')
+    parser.add_argument('--log-sample', type=int, default=1,
+                        help='Log only every N-th per-message record ' +
+                        '(default: 1)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port ' +
+                        '(default: disabled)')
+    parser.add_argument('--metrics-host', type=str, default='127.0.0.1',
+                        help='Metrics endpoint address (default: 127.0.0.1)')
+    parser.add_argument('--metrics-interval', type=float, default=0,
+                        help='Log a metrics summary every N seconds ' +
+                        '(default: 0, disabled)')
+    parser.add_argument('--handoff', type=str, default=None,
+                        help='Unix socket for passing the listening socket ' +
+                        'to a restarted server (default: disabled)')
+    parser.add_argument('--listen-fd', type=int, default=None,
+                        help='Use an inherited listening socket instead of ' +
+                        'binding (set on restart by SIGHUP)')
+    parser.add_argument('--restart-on-hup', action='store_true',
+                        help='On SIGHUP start a successor with the same ' +
+                        'arguments and the listening socket, then drain; ' +
+                        'without it SIGHUP stops the server like SIGTERM')
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help='Seconds to finish serving connected clients ' +
+                        'on shutdown (default: 30)')
+    parser.add_argument('--idle-timeout', type=float, default=60.0,
+                        help='Disconnect a client that sends nothing for N ' +
+                        'seconds, 0 to disable (default: 60)')
+    parser.add_argument('--read-timeout', type=float, default=30.0,
+                        help='Max seconds to receive the rest of a started ' +
+                        'frame, 0 to disable (default: 30)')
+    parser.add_argument('--write-timeout', type=float, default=30.0,
+                        help='Disconnect a client that does not read its ' +
+                        'responses for N seconds, 0 to disable (default: 30)')
+    parser.add_argument('--max-outbound', type=int, default=1024 * 1024,
+                        help='Per-connection unsent bytes before reading ' +
+                        'pauses in async mode (default: 1048576)')
+    parser.add_argument('--memory-budget', type=int,
+                        default=256 * 1024 * 1024,
+                        help='Max bytes of frames held by all connections ' +
+                        'in async mode, 0 to disable (default: 268435456)')
+    parser.add_argument('--compression', type=str, default=None,
+                        help='Allow clients to negotiate compression with ' +
+                        'these codecs, comma separated, framed protocol ' +
+                        f'only ({", ".join(CODECS)}; default: disabled)')
+    parser.add_argument('--compress-level', type=int, default=None,
+                        help='Compression level: zlib -1-9, lzma 0-9, bz2 ' +
+                        '1-9 (default: codec default)')
+    parser.add_argument('--compress-threshold', type=int, default=1024,
+                        help='Compress responses of at least N bytes ' +
+                        '(default: 1024)')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='New connections per second from one IP, ' +
+                        '0 to disable (default: 0)')
+    parser.add_argument('--rate-burst', type=int, default=None,
+                        help='Connections from one IP allowed at once ' +
+                        'before --rate-limit applies (default: one ' +
+                        "second's worth)")
+    parser.add_argument('--subnet-rate-limit', type=float, default=0,
+                        help='New connections per second from one subnet, ' +
+                        '0 to disable (default: 0)')
+    parser.add_argument('--subnet-burst', type=int, default=None,
+                        help='Burst for --subnet-rate-limit (default: one ' +
+                        "second's worth)")
+    parser.add_argument('--max-per-ip', type=int, default=0,
+                        help='Concurrent connections from one IP, 0 to ' +
+                        'disable (default: 0)')
+    parser.add_argument('--ipv4-prefix', type=int, default=24,
+                        help='Subnet prefix length for IPv4 (default: 24)')
+    parser.add_argument('--ipv6-prefix', type=int, default=64,
+                        help='Subnet prefix length for IPv6 (default: 64)')
+    parser.add_argument('--unix', type=str, default=None,
+                        help='Also listen on this Unix socket path for ' +
+                        'local clients (default: disabled)')
+    parser.add_argument('--unix-mode', type=lambda value: int(value, 8),
+                        default=0o660,
+                        help='Permissions of the Unix socket file, octal ' +
+                        '(default: 660)')
+    parser.add_argument('--capture', type=str, default=None,
+                        help='Append connections and received messages ' +
+                        'with timestamps to this file for replay.py ' +
+                        '(default: disabled)')
+    parser.add_argument('--capture-buffer', type=int, default=1024 * 1024,
+                        help='Capture write buffer in bytes, events beyond ' +
+                        'two full buffers are dropped (default: 1048576)')
+    parser.add_argument('--capture-sizes-only', action='store_true',
+                        help='Record message sizes without their contents')
+    parser.add_argument('--profile', choices=MODES, default=None,
+                        help='Allow profiling the message loop: SIGUSR1 ' +
+                        'starts, a second SIGUSR1 logs the per-stage time ' +
+                        'breakdown; cprofile and stacks also write a ' +
+                        '.prof or .folded file (default: disabled)')
+    parser.add_argument('--profile-sample', type=int, default=100,
+                        help='Time every N-th message (default: 100)')
+    parser.add_argument('--profile-output', type=str, default='tcp_profile',
+                        help='Profile file prefix, PID and run number are ' +
+                        'appended (default: tcp_profile)')
+    args = parser.parse_args()
+    if args.compression:
+        if args.protocol != 'framed':
+            parser.error('--compression requires --protocol framed')
+        unknown = set(args.compression.split(',')) - set(CODECS)
+        if unknown:
+            parser.error(f'unsupported codecs: {", ".join(sorted(unknown))}')
+        for name in invalid_level(args.compression.split(','),
+                                  args.compress_level):
+            levels = LEVELS[name]
+            parser.error(f'--compress-level for {name} must be between ' +
+                         f'{levels[0]} and {levels[-1]}')
+    if args.bulk_dir and args.protocol != 'bulk':
+        parser.error('--bulk-dir requires --protocol bulk')
+    if args.capture and args.protocol == 'bulk':
+        # replay.py воспроизводит сообщения, а не потоки файлов
+        parser.error('--capture does not support --protocol bulk')
+    if args.restart_on_hup and not hasattr(signal, 'SIGHUP'):
+        parser.error('--restart-on-hup requires SIGHUP')
+    if args.handoff and not handoff_supported():
+        parser.error('--handoff requires Unix sockets with SCM_RIGHTS')
+    if args.profile and not hasattr(signal, 'SIGUSR1'):
+        parser.error('--profile requires SIGUSR1')
+    if args.unix and not unix_supported():
+        parser.error('--unix requires Unix domain sockets')
+    return args
 
 
-def setup_logging(log_file):
+def setup_logging(log_file, mode='sync', queue_size=10000):
     logger.remove()
-    logger.add(sys.stdout, level="INFO",
+    writer = None
+    target = logger
+    if mode == 'async':
+        # Вывод, запись в файл, ротация и сжатие - в фоновом потоке
+        writer = BackgroundWriter(logger, queue_size)
+        target = writer.logger
+    target.add(sys.stdout, level="INFO",
                format="<green>{time}</green> | <level>{level}</level> | " +
                "{message}")
-    logger.add(log_file, level="DEBUG", rotation="10 MB", compression="zip")
+    target.add(log_file, level="DEBUG", rotation="10 MB", compression="zip")
+    if writer is not None:
+        writer.start(level="DEBUG")
     return logger
 
 
-def start_server(host, port, log):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((host, port))
-        server_socket.listen(5)
+class TcpMetrics:
+    def __init__(self):
+        self.registry = Registry()
+        metric = self.registry
+        self.active = metric.gauge('tcp_active_connections',
+                                   'Connections being served')
+        self.accepts = metric.counter('tcp_accepts_total',
+                                      'Accepted connections')
+        self.rejected = metric.counter('tcp_rejected_total',
+                                       'Connections over the limit')
+        self.refused = metric.counter('tcp_admission_rejected_total',
+                                      'Connections refused by per-address ' +
+                                      'limits')
+        self.messages = metric.counter('tcp_messages_total',
+                                       'Echoed messages')
+        self.received = metric.counter('tcp_received_bytes_total',
+                                       'Bytes received from clients')
+        self.sent = metric.counter('tcp_sent_bytes_total',
+                                   'Bytes sent to clients')
+        self.decode_errors = metric.counter('tcp_decode_errors_total',
+                                            'Malformed frames')
+        self.errors = metric.counter('tcp_connection_errors_total',
+                                     'Connections closed by an error')
+        self.evicted = metric.counter('tcp_evicted_total',
+                                      'Idle, stalled and slow clients ' +
+                                      'disconnected')
+        self.compress_raw = metric.counter(
+            'tcp_compression_raw_bytes_total', 'Bytes before compression ' +
+            'and after decompression')
+        self.compress_wire = metric.counter(
+            'tcp_compression_wire_bytes_total', 'Compressed bytes on the wire')
+        self.compress_cpu = metric.counter(
+            'tcp_compression_cpu_seconds_total', 'CPU time spent ' +
+            'compressing and decompressing')
+        self.bulk = metric.counter('tcp_bulk_transfers_total',
+                                   'Files streamed with the bulk protocol')
+        self.service_time = metric.histogram(
+            'tcp_service_seconds', 'Time from receiving a message to ' +
+            'sending its echo')
+
+    def message(self, received, sent, started):
+        self.messages.inc()
+        self.received.inc(received)
+        self.sent.inc(sent)
+        self.service_time.observe((time.perf_counter_ns() - started) / 1e9)
+
+    def compression(self, codec):
+        self.compress_raw.inc(codec.raw_sent + codec.raw_received)
+        self.compress_wire.inc(codec.wire_sent + codec.wire_received)
+        self.compress_cpu.inc((codec.compress_ns + codec.decompress_ns) / 1e9)
+
+    def error(self, error):
+        if isinstance(error, FrameError):
+            self.decode_errors.inc()
+        else:
+            self.errors.inc()
+
+
+def handle_client(client_socket, addr, log, msg_log=None, metrics=None,
+                  limits=None, profiler=None, capture=None):
+    # При заданных limits таймауты выставлены на сокете, и их истечение
+    # приходит как BlockingIOError
+    msg_log = msg_log or log
+    buffer = memoryview(bytearray(1024))
+    while True:
+        probe = profiler.probe() if profiler is not None else None
+        try:
+            size = client_socket.recv_into(buffer)
+        except BlockingIOError:
+            raise TimeoutError(limits.reason(IDLE))
+        started = time.perf_counter_ns()
+        if not size:
+            log.debug(f"Client {addr} disconnected")
+            break
+        if probe is not None:
+            probe.mark('recv')
+
+        data = buffer[:size]
+        if capture is not None:
+            capture.received(data, started)
+        msg_log.info("Received from {}: {}", addr, LazyText(data))
+        if probe is not None:
+            probe.mark('log')
+
+        # Эхо-ответ
+        try:
+            send_buffers(client_socket, [ECHO_PREFIX, data])
+        except BlockingIOError:
+            raise TimeoutError(limits.reason(WRITING))
+        if capture is not None:
+            capture.sent()
+        if probe is not None:
+            probe.mark('send')
+        msg_log.debug("Sent response to {}", addr)
+        if probe is not None:
+            probe.mark('log')
+        if metrics is not None:
+            metrics.message(size, size + len(ECHO_PREFIX), started)
+        if probe is not None:
+            probe.mark('metrics')
+            profiler.record(probe)
+
+
+def negotiate_compression(payload, addr, log, compression, max_frame_size):
+    # Первый кадр клиента может быть HELLO со списком кодеков
+    codec, reply = accept(compression, payload, max_frame_size)
+    log.info(f"Client {addr} compression: " +
+             f"{codec.codec if codec else 'none'}")
+    return codec, reply
+
+
+def report_compression(codec, addr, log, metrics=None):
+    if codec is None:
+        return
+    log.info(f"Compression for {addr}: {codec.summary()}")
+    if metrics is not None:
+        metrics.compression(codec)
+
+
+def handle_client_framed(client_socket, addr, log,
+                         max_frame_size=MAX_FRAME_SIZE, msg_log=None,
+                         metrics=None, limits=None, compression=None,
+                         profiler=None, capture=None):
+    msg_log = msg_log or log
+    reader = FrameReader(client_socket, max_frame_size,
+                         read_timeout=limits.read_timeout if limits else None,
+                         idle_timeout=limits.idle_timeout if limits else None)
+    negotiating = compression is not None
+    codec = None
+    try:
+        while True:
+            probe = profiler.probe() if profiler is not None else None
+            try:
+                frame = reader.read_frame()
+            except BlockingIOError:
+                raise TimeoutError(limits.reason(IDLE))
+            started = time.perf_counter_ns()
+            if frame is None:
+                log.debug(f"Client {addr} disconnected")
+                break
+
+            if negotiating:
+                negotiating = False
+                if is_hello(frame):
+                    codec, reply = negotiate_compression(
+                        frame, addr, log, compression, max_frame_size)
+                    send_frame(client_socket, reply, max_frame_size)
+                    continue
+            if probe is not None:
+                probe.mark('recv')
+            payload = frame if codec is None else codec.decode(frame)
+            if probe is not None:
+                probe.mark('decode')
+            if capture is not None:
+                capture.received(payload, started)
+            msg_log.info("Received from {}: {}", addr, LazyText(payload))
+            if probe is not None:
+                probe.mark('log')
+
+            # Эхо-ответ, ровно один кадр на каждый принятый кадр
+            if codec is None:
+                prefix, body = ECHO_PREFIX, payload
+            else:
+                prefix, body = codec.encode(payload, ECHO_PREFIX)
+            if probe is not None:
+                probe.mark('encode')
+            try:
+                send_frame(client_socket, body, max_frame_size, prefix)
+            except BlockingIOError:
+                raise TimeoutError(limits.reason(WRITING))
+            if capture is not None:
+                capture.sent()
+            if probe is not None:
+                probe.mark('send')
+            msg_log.debug("Sent response to {}", addr)
+            if probe is not None:
+                probe.mark('log')
+            if metrics is not None:
+                metrics.message(HEADER.size + len(frame),
+                                HEADER.size + len(prefix) + len(body),
+                                started)
+            if probe is not None:
+                probe.mark('metrics')
+                profiler.record(probe)
+    finally:
+        report_compression(codec, addr, log, metrics)
+
+
+def open_sink(bulk_dir, log):
+    # Поток пишется в новый файл каталога или никуда
+    if bulk_dir is None:
+        return open(os.devnull, 'wb')
+    fd, path = tempfile.mkstemp(prefix='bulk_', suffix='.bin', dir=bulk_dir)
+    log.debug(f"Bulk transfer into {path}")
+    return os.fdopen(fd, 'wb')
+
+
+def report_bulk(operation, addr, size, moved, started, log, metrics=None):
+    elapsed = time.perf_counter() - started
+    if moved < size:
+        log.warning(f"Bulk {operation} from {addr} cut short: {moved} of " +
+                    f"{size} bytes")
+    log.info(f"Bulk {operation} from {addr}: {moved} bytes in " +
+             f"{elapsed:.3f}s, {throughput(moved, elapsed)}")
+    if metrics is not None:
+        metrics.bulk.inc()
+        metrics.received.inc(BULK_HEADER.size + moved)
+        metrics.sent.inc(moved if operation == 'echo' else BULK_RESULT.size)
+
+
+def handle_client_bulk(client_socket, addr, log, bulk_dir=None,
+                       metrics=None, limits=None):
+    # Блокирующий режим: данные идут через os.splice, память не зависит
+    # от размера файла
+    try:
+        header = recv_exactly(client_socket, BULK_HEADER.size)
+        if header is None:
+            log.debug(f"Client {addr} disconnected")
+            return
+        operation, size = BULK_HEADER.unpack(header)
+        started = time.perf_counter()
+        if operation == SINK:
+            with open_sink(bulk_dir, log) as target:
+                moved = pump(client_socket, size, target)
+            client_socket.sendall(BULK_RESULT.pack(moved))
+        elif operation == ECHO:
+            moved = pump(client_socket, size)
+        else:
+            raise FrameError(f"Unknown bulk operation {operation!r}")
+    except BlockingIOError:
+        raise TimeoutError(limits.reason(IDLE))
+    report_bulk('sink' if operation == SINK else 'echo', addr, size, moved,
+                started, log, metrics)
+
+
+def create_listener(host, port, backlog):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(backlog)
+    return server_socket
+
+
+def disconnect(client_socket):
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # Клиент уже отключился
 
+
+def refuse(client_socket, addr, reason, log, metrics=None):
+    # После SO_LINGER 0 закрытие сокета отправляет RST: отказанное
+    # соединение не висит в TIME_WAIT. Закрывает вызывающий
+    log.debug(f"Refusing {addr[0]}:{addr[1]}: {reason}")
+    if metrics is not None:
+        metrics.refused.inc()
+    try:
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                 struct.pack('ii', 1, 0))
+    except OSError:
+        pass  # Клиент уже отключился
+
+
+def start_server(host, port, log, backlog=5, protocol='raw',
+                 max_frame_size=MAX_FRAME_SIZE, msg_log=None, metrics=None,
+                 listener=None, shutdown=None, limits=None, compression=None,
+                 admission=None, profiler=None, unix=None, capture=None,
+                 bulk_dir=None):
+    if listener is None:
+        listener = create_listener(host, port, backlog)
+    current = [None]
+
+    def cut_off():
+        # Срок вышел - обрываем клиента, которого ещё обслуживаем
+        if current[0] is not None:
+            disconnect(current[0])
+
+    def drain():
+        timer = threading.Timer(shutdown.drain_timeout, cut_off)
+        timer.daemon = True
+        timer.start()
+
+    if shutdown is not None:
+        shutdown.on_request(drain)
+
+    with listener as server_socket:
+        # accept с таймаутом, чтобы проверять флаг остановки и чтобы
+        # Ctrl+C срабатывал и в Windows
+        server_socket.settimeout(1.0)
+        listeners = [server_socket]
+        if unix is not None:
+            unix.socket.settimeout(1.0)
+            listeners.append(unix.socket)
+            log.info(f"Also listening on {unix.name}")
         log.info(f"Server started on {host}:{port}. Waiting for connections..."
                  )
 
         try:
-            while True:
-                client_socket, addr = server_socket.accept()
+            while shutdown is None or not shutdown.requested.is_set():
+                accepting = server_socket
+                if unix is not None:
+                    ready = select.select(listeners, [], [], 1.0)[0]
+                    if not ready:
+                        continue
+                    # Сокеты по очереди, чтобы поток TCP-клиентов не
+                    # задерживал локальных, и наоборот
+                    accepting = ready[0]
+                    listeners.reverse()
+                try:
+                    client_socket, addr = accepting.accept()
+                except socket.timeout:
+                    continue
+                local = accepting is not server_socket
+                if local:
+                    addr = unix.client_addr()
+                elif admission is not None:
+                    reason = admission.connect(addr[0])
+                    if reason is not None:
+                        refuse(client_socket, addr, reason, log, metrics)
+                        client_socket.close()
+                        continue
                 log.info(f"New connection from {addr[0]}:{addr[1]}")
+                if metrics is not None:
+                    metrics.accepts.inc()
+                    metrics.active.inc()
 
+                current[0] = client_socket
+                stream = capture.open() if capture is not None else None
                 with client_socket:
-                    while True:
-                        data = client_socket.recv(1024)
-                        if not data:
-                            log.debug(f"Client {addr} disconnected")
-                            break
-
-                        message = data.decode('utf-8')
-                        log.info(f"Received from {addr}: {message}")
-
-                        # Эхо-ответ
-                        response = f"ECHO: {message}"
-                        client_socket.sendall(response.encode('utf-8'))
-                        log.debug(f"Sent response to {addr}")
-        except KeyboardInterrupt:  # Не работает
+                    try:
+                        if limits is not None:
+                            set_socket_timeouts(client_socket,
+                                                limits.idle_timeout,
+                                                limits.write_timeout)
+                        if protocol == 'framed':
+                            handle_client_framed(client_socket, addr, log,
+                                                 max_frame_size, msg_log,
+                                                 metrics, limits, compression,
+                                                 profiler, stream)
+                        elif protocol == 'bulk':
+                            handle_client_bulk(client_socket, addr, log,
+                                               bulk_dir, metrics, limits)
+                        else:
+                            handle_client(client_socket, addr, log, msg_log,
+                                          metrics, limits, profiler, stream)
+                    except TimeoutError as e:
+                        # Клиент молчит или не читает ответы - не даём ему
+                        # занимать сервер
+                        log.warning(f"Evicting client {addr}: {e}")
+                        if metrics is not None:
+                            metrics.evicted.inc()
+                    except (ConnectionError, FrameError) as e:
+                        log.error(f"Client {addr} error: {e}")
+                        if metrics is not None:
+                            metrics.error(e)
+                    finally:
+                        current[0] = None
+                        if stream is not None:
+                            stream.close()
+                        if admission is not None and not local:
+                            admission.disconnect(addr[0])
+                        if metrics is not None:
+                            metrics.active.dec()
+            log.info("Server stopped")
+        except KeyboardInterrupt:
             log.info("Server shutdown by administrator")
+        if admission is not None:
+            log.info(f"Admission: {admission.summary()}")
+
+
+async def handle_client_async(reader, writer, addr, log, msg_log=None,
+                              metrics=None, connection=None, profiler=None,
+                              capture=None):
+    msg_log = msg_log or log
+    connection = connection or Connection(addr, writer.transport)
+    while True:
+        probe = profiler.probe() if profiler is not None else None
+        connection.enter(IDLE)
+        data = await reader.read(1024)
+        started = time.perf_counter_ns()
+        if not data:
+            log.debug(f"Client {addr} disconnected")
+            break
+        if probe is not None:
+            probe.mark('recv')
+
+        if capture is not None:
+            capture.received(data, started)
+        msg_log.info("Received from {}: {}", addr, LazyText(data))
+        if probe is not None:
+            probe.mark('log')
+
+        # Эхо-ответ
+        writer.writelines([ECHO_PREFIX, data])
+        connection.enter(WRITING)
+        await writer.drain()
+        if capture is not None:
+            capture.sent()
+        if probe is not None:
+            probe.mark('send')
+        msg_log.debug("Sent response to {}", addr)
+        if probe is not None:
+            probe.mark('log')
+        if metrics is not None:
+            metrics.message(len(data), len(data) + len(ECHO_PREFIX), started)
+        if probe is not None:
+            probe.mark('metrics')
+            profiler.record(probe)
+
+
+async def handle_client_framed_async(reader, writer, addr, log,
+                                     max_frame_size=MAX_FRAME_SIZE,
+                                     msg_log=None, metrics=None,
+                                     connection=None, compression=None,
+                                     profiler=None, capture=None):
+    msg_log = msg_log or log
+    connection = connection or Connection(addr, writer.transport)
+    negotiating = compression is not None
+    codec = None
+    try:
+        while True:
+            probe = profiler.probe() if profiler is not None else None
+            connection.enter(IDLE)
+            frame = await read_frame_async(reader, max_frame_size,
+                                           connection.frame_started)
+            started = time.perf_counter_ns()
+            if frame is None:
+                log.debug(f"Client {addr} disconnected")
+                break
+
+            if negotiating:
+                negotiating = False
+                if is_hello(frame):
+                    codec, reply = negotiate_compression(
+                        frame, addr, log, compression, max_frame_size)
+                    write_frame_async(writer, reply, max_frame_size)
+                    await connection.frame_done()
+                    continue
+            if probe is not None:
+                probe.mark('recv')
+            payload = frame if codec is None else codec.decode(frame)
+            if probe is not None:
+                probe.mark('decode')
+            if capture is not None:
+                capture.received(payload, started)
+            msg_log.info("Received from {}: {}", addr, LazyText(payload))
+            if probe is not None:
+                probe.mark('log')
+
+            if codec is None:
+                prefix, body = ECHO_PREFIX, payload
+            else:
+                prefix, body = codec.encode(payload, ECHO_PREFIX)
+            if probe is not None:
+                probe.mark('encode')
+            write_frame_async(writer, body, max_frame_size, prefix)
+            connection.enter(WRITING)
+            await writer.drain()
+            await connection.frame_done()
+            if capture is not None:
+                capture.sent()
+            if probe is not None:
+                probe.mark('send')
+            msg_log.debug("Sent response to {}", addr)
+            if probe is not None:
+                probe.mark('log')
+            if metrics is not None:
+                metrics.message(HEADER.size + len(frame),
+                                HEADER.size + len(prefix) + len(body),
+                                started)
+            if probe is not None:
+                probe.mark('metrics')
+                profiler.record(probe)
+    finally:
+        report_compression(codec, addr, log, metrics)
+
+
+async def handle_client_bulk_async(reader, writer, addr, log, bulk_dir=None,
+                                   metrics=None, connection=None):
+    # Транспорт asyncio не отдаёт сокет для os.splice: поток идёт кусками
+    # до CHUNK_SIZE, в буфере чтения и записи не больше их лимитов. Диск
+    # может тормозить, поэтому файл пишется в потоке, пока читается
+    # следующий кусок, и цикл событий не ждёт
+    connection = connection or Connection(addr, writer.transport)
+    try:
+        header = await reader.readexactly(BULK_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            log.debug(f"Client {addr} disconnected")
+            return
+        raise ConnectionResetError("Connection closed in the middle of a " +
+                                   "bulk header")
+    operation, size = BULK_HEADER.unpack(header)
+    if operation not in (SINK, ECHO):
+        raise FrameError(f"Unknown bulk operation {operation!r}")
+    started = time.perf_counter()
+    target = None
+    if operation == SINK:
+        target = await asyncio.to_thread(open_sink, bulk_dir, log)
+    moved = 0
+    pending = bytearray()
+    writing = None
+    try:
+        while moved < size:
+            connection.enter(IDLE)
+            chunk = await reader.read(min(CHUNK_SIZE, size - moved))
+            if not chunk:
+                break
+            moved += len(chunk)
+            if target is None:
+                writer.write(chunk)
+                connection.enter(WRITING)
+                await writer.drain()
+                continue
+            # Чтение отдаёт куски по 64 КБ: в поток уходит до CHUNK_SIZE
+            # за раз и не больше одной записи на диск одновременно
+            pending += chunk
+            if len(pending) >= CHUNK_SIZE or moved == size:
+                if writing is not None:
+                    await writing
+                writing = asyncio.ensure_future(
+                    asyncio.to_thread(target.write, pending))
+                pending = bytearray()
+        if pending:
+            await asyncio.to_thread(target.write, pending)
+        if writing is not None:
+            await writing
+    finally:
+        if target is not None:
+            if writing is not None:
+                # Файл закрывается после последней начатой записи
+                await asyncio.wait([writing])
+            await asyncio.to_thread(target.close)
+    if target is not None:
+        writer.write(BULK_RESULT.pack(moved))
+        await writer.drain()
+    report_bulk('sink' if operation == SINK else 'echo', addr, size, moved,
+                started, log, metrics)
+
+
+async def serve_async(host, port, log, backlog, max_connections,
+                      protocol='raw', max_frame_size=MAX_FRAME_SIZE,
+                      msg_log=None, metrics=None, listener=None,
+                      shutdown=None, limits=None, compression=None,
+                      admission=None, profiler=None, unix=None,
+                      capture=None, bulk_dir=None):
+    # Все клиенты обслуживаются в одном цикле событий, медленный клиент
+    # не задерживает остальных
+    slots = asyncio.Semaphore(max_connections)
+    clients = {}
+    budget = None
+    if limits is not None and limits.memory_budget:
+        budget = MemoryBudget(limits.memory_budget, limits.read_timeout)
+    stopping = asyncio.Event()
+    if shutdown is not None:
+        loop = asyncio.get_running_loop()
+        shutdown.on_request(lambda: loop.call_soon_threadsafe(stopping.set))
+
+    async def handle_client(reader, writer):
+        task = asyncio.current_task()
+        addr = writer.get_extra_info('peername')
+        local = writer.get_extra_info('socket').family == socket.AF_UNIX
+        if local:
+            addr = unix.client_addr()
+        elif admission is not None:
+            reason = admission.connect(addr[0])
+            if reason is not None:
+                refuse(writer.get_extra_info('socket'), addr, reason, log,
+                       metrics)
+                writer.transport.abort()
+                return
+        clients[task] = connection = Connection(addr, writer.transport,
+                                                budget)
+        try:
+            await serve_client(reader, writer, addr, connection)
+        finally:
+            del clients[task]
+            await connection.frame_done()
+            if admission is not None and not local:
+                admission.disconnect(addr[0])
+
+    async def serve_client(reader, writer, addr, connection):
+        if slots.locked():
+            log.warning(f"Connection limit reached, rejecting {addr[0]}:"
+                        f"{addr[1]}")
+            if metrics is not None:
+                metrics.rejected.inc()
+            writer.close()
+            return
+
+        async with slots:
+            log.info(f"New connection from {addr[0]}:{addr[1]}")
+            stream = capture.open() if capture is not None else None
+            if limits is not None:
+                # Пока ответы не ушли клиенту, transport держит не больше
+                # max_outbound байт, дальше drain() ждёт и чтение стоит
+                writer.transport.set_write_buffer_limits(
+                    high=limits.max_outbound)
+            if metrics is not None:
+                metrics.accepts.inc()
+                metrics.active.inc()
+            try:
+                if protocol == 'framed':
+                    await handle_client_framed_async(reader, writer, addr,
+                                                     log, max_frame_size,
+                                                     msg_log, metrics,
+                                                     connection, compression,
+                                                     profiler, stream)
+                elif protocol == 'bulk':
+                    await handle_client_bulk_async(reader, writer, addr, log,
+                                                   bulk_dir, metrics,
+                                                   connection)
+                else:
+                    await handle_client_async(reader, writer, addr, log,
+                                              msg_log, metrics, connection,
+                                              profiler, stream)
+            except TimeoutError as e:
+                log.warning(f"Evicting client {addr}: {e}")
+                if metrics is not None:
+                    metrics.evicted.inc()
+            except (ConnectionError, FrameError) as e:
+                # Отключённый по таймауту клиент уже записан в лог
+                if connection.evicted is None:
+                    log.error(f"Client {addr} error: {e}")
+                    if metrics is not None:
+                        metrics.error(e)
+            finally:
+                if stream is not None:
+                    stream.close()
+                if metrics is not None:
+                    metrics.active.dec()
+                writer.close()
+
+    if listener is not None:
+        server = await asyncio.start_server(handle_client, sock=listener,
+                                            backlog=backlog)
+    else:
+        server = await asyncio.start_server(handle_client, host, port,
+                                            backlog=backlog,
+                                            reuse_address=True)
+    servers = [server]
+    if unix is not None:
+        servers.append(await asyncio.start_unix_server(
+            handle_client, sock=unix.socket, backlog=backlog))
+        log.info(f"Also listening on {unix.name}")
+    log.info(f"Async server started on {host}:{port}. Waiting for " +
+             "connections...")
+    sweeper = None
+    if limits is not None:
+        sweeper = asyncio.create_task(evict_stalled(clients.values(), limits,
+                                                    log, metrics))
+    async with server:
+        await stopping.wait()
+        # Сначала перестаём принимать, и только когда уже принятые
+        # соединения дойдут до обработчиков, закрываем сервер: иначе
+        # соединение, принятое в момент close(), будет сброшено
+        loop = asyncio.get_running_loop()
+        for sock in (sock for running in servers for sock in running.sockets):
+            try:
+                loop.remove_reader(sock.fileno())
+            except NotImplementedError:
+                pass  # ProactorEventLoop в Windows
+        await asyncio.sleep(0.1)
+        for running in servers:
+            running.close()
+        if clients:
+            _, unfinished = await asyncio.wait(set(clients),
+                                               timeout=shutdown.drain_timeout)
+            # Обрываем соединения, обработчики завершатся как при
+            # отключении клиента
+            for task in unfinished:
+                clients[task].transport.abort()
+            if unfinished:
+                log.warning(f"Drain timeout, closed {len(unfinished)} " +
+                            "clients")
+                await asyncio.wait(unfinished)
+    if sweeper is not None:
+        sweeper.cancel()
+    log.info("Server stopped")
+
+
+def start_async_server(host, port, log, backlog=socket.SOMAXCONN,
+                       max_connections=1000, protocol='raw',
+                       max_frame_size=MAX_FRAME_SIZE, msg_log=None,
+                       metrics=None, listener=None, shutdown=None,
+                       limits=None, compression=None, admission=None,
+                       profiler=None, unix=None, capture=None,
+                       bulk_dir=None):
+    try:
+        asyncio.run(serve_async(host, port, log, backlog, max_connections,
+                                protocol, max_frame_size, msg_log, metrics,
+                                listener, shutdown, limits, compression,
+                                admission, profiler, unix, capture,
+                                bulk_dir))
+    except KeyboardInterrupt:
+        log.info("Server shutdown by administrator")
+    if admission is not None:
+        log.info(f"Admission: {admission.summary()}")
 
 
 if __name__ == '__main__':
     args = parse_args()
-    log = setup_logging(args.log)
-    start_server(args.host, args.port, log)
+    log = setup_logging(args.log, args.log_mode, args.log_queue)
+    msg_log = sample_messages(log, args.log_sample)
+    metrics = None
+    if args.metrics_port or args.metrics_interval:
+        metrics = TcpMetrics()
+        serve_metrics(metrics.registry, log, args.metrics_host,
+                      args.metrics_port, args.metrics_interval)
+    backlog = args.backlog or (socket.SOMAXCONN if args.mode == 'async'
+                               else 5)
+
+    # Слушающий сокет либо достаётся от предыдущего процесса, либо
+    # создаётся заново; с --restart-on-hup SIGHUP запускает преемника с
+    # этим же сокетом
+    listener = inherit_listener(args.listen_fd, args.handoff, log)
+    inherited = listener is not None
+    if listener is None:
+        listener = create_listener(args.host, args.port, backlog)
+    shutdown = GracefulShutdown(log, args.drain_timeout,
+                                listener if args.restart_on_hup else None)
+    shutdown.install()
+    limits = ConnectionLimits(args.idle_timeout, args.read_timeout,
+                              args.write_timeout, args.max_outbound,
+                              args.memory_budget)
+    compression = None
+    if args.compression:
+        compression = CompressionOptions(args.compression.split(','),
+                                         args.compress_level,
+                                         args.compress_threshold)
+    admission = None
+    if args.rate_limit or args.subnet_rate_limit or args.max_per_ip:
+        admission = Admission(args.rate_limit, args.rate_burst,
+                              args.subnet_rate_limit, args.subnet_burst,
+                              args.max_per_ip, args.ipv4_prefix,
+                              args.ipv6_prefix)
+    profiler = None
+    if args.profile:
+        profiler = StageProfiler(log, args.profile_sample, args.profile,
+                                 args.profile_output)
+        profiler.install()
+        log.info(f"Profiler ready, send SIGUSR1 to process {os.getpid()} " +
+                 "to start")
+    # Преемник подменяет файл Unix-сокета, старый процесс дообслуживает
+    # своих клиентов
+    unix = None
+    if args.unix:
+        unix = UnixEndpoint(args.unix, socket.SOCK_STREAM, args.unix_mode,
+                            backlog, replace=inherited)
+    capture = None
+    if args.capture:
+        capture = TrafficCapture(args.capture, f'tcp-{args.protocol}',
+                                 args.capture_buffer,
+                                 not args.capture_sizes_only)
+        log.info(f"Capturing traffic to {args.capture}")
+    handoff = None
+    if args.handoff:
+        handoff = HandoffServer(args.handoff, listener,
+                                lambda: shutdown.request("Handed off"), log)
+
+    try:
+        if args.mode == 'async':
+            start_async_server(args.host, args.port, log, backlog,
+                               args.max_connections, args.protocol,
+                               args.max_frame_size, msg_log, metrics,
+                               listener, shutdown, limits, compression,
+                               admission, profiler, unix, capture,
+                               args.bulk_dir)
+        else:
+            start_server(args.host, args.port, log, backlog, args.protocol,
+                         args.max_frame_size, msg_log, metrics, listener,
+                         shutdown, limits, compression, admission, profiler,
+                         unix, capture, args.bulk_dir)
+    finally:
+        if capture is not None:
+            capture.close()
+            log.info(f"Capture: {capture.summary()}")
+        if handoff is not None:
+            handoff.close()
+        if unix is not None:
+            unix.close()
@@ -0,0 +1,87 @@
+# Кэш ответов UDP-сервера: датаграмма, которую клиент прислал повторно
+# (ретрансмиссия после таймаута), получает сохранённый ответ без
+# повторной обработки. Записи вытесняются по LRU при превышении лимита
+# памяти и устаревают через ttl секунд.
+from collections import OrderedDict
+import re
+import time
+
+# Запрос udp_client --input: "<номер hex>.<попытка>:<сообщение>". Номер
+# попытки в ключ не входит - это один и тот же запрос. Клиент, начавший
+# нумерацию заново с того же порта, повторит номер с другим сообщением,
+# поэтому сообщение хранится в записи и сверяется при попадании
+REQUEST_TAG = re.compile(rb'([0-9a-f]+)\.\d+:')
+# Оценка памяти на запись сверх данных: ключ, кортежи, узел OrderedDict
+ENTRY_OVERHEAD = 200
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=30.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # ключ -> (срок годности, ответ, занимаемая память, сообщение
+        # запроса с номером или None)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def lookup(self, addr, payload):
+        # Возвращает (ключ, длина тега, ответ или None). Тег запроса
+        # (номер и попытка) не кэшируется: ответ на повтор собирается из
+        # тега нового запроса и сохранённого ответа
+        match = REQUEST_TAG.match(payload)
+        if match:
+            key = (addr, match.group(1))
+            tag_size = match.end()
+        else:
+            # Без номера запрос опознаётся по содержимому целиком
+            key = (addr, bytes(payload))
+            tag_size = 0
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            # Тот же номер с другим сообщением - новый запрос
+            same = entry[3] is None or payload[tag_size:] == entry[3]
+            if same and entry[0] >= time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return key, tag_size, entry[1]
+            self._remove(key)
+        self.misses += 1
+        return key, tag_size, None
+
+    def store(self, key, response, request=None):
+        # request - сообщение запроса с номером без тега
+        cost = len(response) + ENTRY_OVERHEAD
+        if response is not key[1]:
+            cost += len(key[1])
+        if request is not None and request is not response:
+            cost += len(request)
+        if cost > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, response, cost,
+                             request)
+        self.size += cost
+
+        # Сначала устаревшие записи в начале очереди, затем LRU
+        now = time.monotonic()
+        while self.entries:
+            oldest = next(iter(self.entries))
+            expired = self.entries[oldest][0] < now
+            if not expired and self.size <= self.max_bytes:
+                break
+            self._remove(oldest)
+            if not expired:
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return (f"{self.hits} hits, {self.misses} misses ({rate:.1f}% hit " +
+                f"rate), {len(self.entries)} entries, {self.size} bytes, " +
+                f"{self.evictions} evicted")
@@ -1,5 +1,10 @@
 import argparse
+from contextlib import contextmanager
+import os
+import select
 import socket
+import tempfile
+import time
 from loguru import logger
 import sys
 
@@ -10,8 +15,12 @@ def parse_args():
                         help='Server IP address (default: 127.0.0.1)')
     parser.add_argument('--port', type=int, default=5000,
                         help='Server port (default: 5000)')
-    parser.add_argument('--message', type=str, required=True,
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--message', type=str,
                         help='Message to send')
+    source.add_argument('--input', type=str,
+                        help='File with one message per line to send ' +
+                        'concurrently with sequence numbers, "-" for stdin')
     parser.add_argument('--log', type=str,
                         default='1_Presentation/2_Practice/2_UDP_client_and_' +
                         'UDP_server_implementation/udp_client.log',
@@ -22,7 +31,24 @@ def parse_args():
                         help='Response timeout in seconds (default: 5.0)')
     parser.add_argument('--retry', type=int, default=3,
                         help='Max retry attempts (default: 3)')
-    return parser.parse_args()
+    parser.add_argument('--window', type=int, default=32,
+                        help='Max requests in flight with --input ' +
+                        '(default: 32)')
+    parser.add_argument('--min-rto', type=float, default=0.05,
+                        help='Lower bound of the adaptive timeout with ' +
+                        '--input in seconds (default: 0.05)')
+    parser.add_argument('--unix', type=str, default=None,
+                        help='Send to the server Unix socket at this path ' +
+                        'instead of --host/--port')
+    parser.add_argument('--unix-mode', type=lambda value: int(value, 8),
+                        default=0o660,
+                        help='Permissions of the client reply socket with ' +
+                        '--unix, octal; the server user must be able to ' +
+                        'write to it (default: 660)')
+    args = parser.parse_args()
+    if args.unix and not hasattr(socket, 'AF_UNIX'):
+        parser.error('--unix requires Unix domain sockets')
+    return args
 
 
 def setup_logging(log_file):
@@ -34,16 +60,47 @@ def setup_logging(log_file):
     return logger
 
 
-def run_client(host, port, message, timeout, retry, log):
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
+@contextmanager
+def open_socket(host, port, unix=None, unix_mode=0o660):
+    # Возвращает (сокет, адрес сервера, имя для логов). Датаграммный
+    # Unix-сокет клиента привязывается к своему пути, иначе серверу
+    # некуда отправить ответ. Путь - в собственном каталоге со случайным
+    # именем: серверу он доступен только для прохода (0711), а права
+    # самого сокета (unix_mode) должны пускать пользователя сервера
+    if not unix:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
+            yield client_socket, (host, port), f"{host}:{port}"
+        return
+    directory = tempfile.mkdtemp(prefix='udp_client_')
+    path = os.path.join(directory, 'reply.sock')
+    try:
+        os.chmod(directory, 0o711)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as client_socket:
+            # Права задаются при создании файла, без окна с правами umask
+            umask = os.umask(0o777 & ~unix_mode)
+            try:
+                client_socket.bind(path)
+            finally:
+                os.umask(umask)
+            os.chmod(path, unix_mode)
+            yield client_socket, unix, f"unix:{unix}"
+    finally:
+        if os.path.lexists(path):
+            os.unlink(path)
+        os.rmdir(directory)
+
+
+def run_client(host, port, message, timeout, retry, log, unix=None,
+               unix_mode=0o660):
+    with open_socket(host, port, unix, unix_mode) as (client_socket,
+                                                      server_address, name):
         client_socket.settimeout(timeout)
-        server_address = (host, port)
 
         for attempt in range(1, retry + 1):
             try:
                 # Отправка сообщения
                 client_socket.sendto(message.encode('utf-8'), server_address)
-                log.debug(f"Attempt {attempt}: Sent message to {host}:{port}")
+                log.debug(f"Attempt {attempt}: Sent message to {name}")
 
                 # Получение ответа
                 response, _ = client_socket.recvfrom(1024)
@@ -59,8 +116,193 @@ def run_client(host, port, message, timeout, retry, log):
         log.error("All retry attempts failed. No response from server.")
 
 
+class RttEstimator:
+    # Адаптивный таймаут по RFC 6298: сглаженное RTT (SRTT) и его разброс
+    # (RTTVAR), RTO = SRTT + 4 * RTTVAR
+
+    def __init__(self, initial_rto=1.0, min_rto=0.05, max_rto=60.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto),
+                       self.max_rto)
+
+    def timeout(self, attempt):
+        # Экспоненциальная задержка для повторных попыток
+        return min(self.rto * 2 ** (attempt - 1), self.max_rto)
+
+
+def encode_request(seq, attempt, message):
+    # Номер запроса и попытки идут в начале датаграммы, сервер возвращает
+    # их вместе с эхом: "ACK: <seq>.<attempt>:<message>"
+    return f"{seq:x}.{attempt}:{message}".encode('utf-8')
+
+
+def decode_response(response):
+    if not response.startswith(b'ACK: '):
+        return None
+    tag, separator, _ = response[5:].partition(b':')
+    seq, dot, attempt = tag.partition(b'.')
+    if not separator or not dot:
+        return None
+    try:
+        return int(seq, 16), int(attempt)
+    except ValueError:
+        return None
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(p / 100 * len(sorted_values)))]
+
+
+def run_reliable_client(host, port, messages, log, window=32, timeout=5.0,
+                        retry=3, min_rto=0.05, unix=None, unix_mode=0o660):
+    estimator = RttEstimator(timeout, min_rto)
+    messages = iter(messages)
+    exhausted = False
+    next_seq = 0
+    # seq -> [message, время первой отправки, номер попытки,
+    #         {попытка: время отправки}]
+    pending = {}
+    latencies = []
+    failed = retransmits = duplicates = 0
+
+    with open_socket(host, port, unix, unix_mode) as (client_socket,
+                                                      server_address, name):
+        try:
+            client_socket.connect(server_address)
+        except (ConnectionRefusedError, FileNotFoundError):
+            log.error("Server is not available")
+            return
+        client_socket.setblocking(False)
+        started = time.perf_counter()
+
+        def send(seq, attempt):
+            request = pending[seq]
+            request[2] = attempt
+            request[3][attempt] = time.perf_counter()
+            datagram = encode_request(seq, attempt, request[0])
+            try:
+                client_socket.send(datagram)
+            except BlockingIOError:
+                # Очередь Unix-сокета сервера короткая (net.unix.
+                # max_dgram_qlen), место в ней освобождается быстро
+                select.select([], [client_socket], [],
+                              estimator.timeout(attempt))
+                try:
+                    client_socket.send(datagram)
+                except (BlockingIOError, ConnectionRefusedError):
+                    pass  # Повтор произойдёт по таймауту
+            except ConnectionRefusedError:
+                pass
+
+        def expire():
+            # Срок ответа считается от текущего RTO, поэтому запросы,
+            # отправленные до первых замеров RTT, не ждут начальный таймаут
+            nonlocal failed, retransmits
+            now = time.perf_counter()
+            nearest = None
+            for seq, request in list(pending.items()):
+                attempt = request[2]
+                deadline = request[3][attempt] + estimator.timeout(attempt)
+                if deadline <= now:
+                    if attempt >= retry:
+                        del pending[seq]
+                        failed += 1
+                        log.warning(f"Request {seq}: no response after " +
+                                    f"{retry} attempts")
+                        continue
+                    retransmits += 1
+                    send(seq, attempt + 1)
+                    deadline = now + estimator.timeout(attempt + 1)
+                if nearest is None or deadline < nearest:
+                    nearest = deadline
+            return nearest
+
+        while not exhausted or pending:
+            while not exhausted and len(pending) < window:
+                message = next(messages, None)
+                if message is None:
+                    exhausted = True
+                    break
+                pending[next_seq] = [message, time.perf_counter(), 0, {}]
+                send(next_seq, 1)
+                next_seq += 1
+            nearest = expire()
+            if nearest is None:
+                continue
+
+            wait = max(nearest - time.perf_counter(), 0)
+            readable, _, _ = select.select([client_socket], [], [], wait)
+            while readable:
+                try:
+                    response = client_socket.recv(65536)
+                except BlockingIOError:
+                    break
+                except ConnectionRefusedError:
+                    log.warning("Server is not available")
+                    break
+                received_at = time.perf_counter()
+                tag = decode_response(response)
+                if tag is None or tag[0] not in pending:
+                    duplicates += 1
+                    continue
+                seq, attempt = tag
+                request = pending[seq]
+                sent_at = request[3].get(attempt)
+                if sent_at is None:
+                    duplicates += 1
+                    continue
+                del pending[seq]
+                # Ответ привязан к конкретной попытке, поэтому RTT
+                # измеряется верно и для повторных отправок
+                estimator.sample(received_at - sent_at)
+                latencies.append(received_at - request[1])
+                log.debug(f"Response {seq} (attempt {attempt}): " +
+                          f"{response.decode('utf-8', 'replace')}")
+
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    log.info(f"Completed {len(latencies)} requests in {elapsed:.3f}s " +
+             f"({len(latencies) / elapsed:.1f} req/s), {failed} failed, " +
+             f"{retransmits} retransmits, {duplicates} late or duplicate " +
+             "responses")
+    if latencies:
+        log.info(f"Latency ms: p50 {percentile(latencies, 50) * 1000:.3f}, " +
+                 f"p99 {percentile(latencies, 99) * 1000:.3f}, max " +
+                 f"{latencies[-1] * 1000:.3f}; final RTO " +
+                 f"{estimator.rto * 1000:.1f} ms")
+
+
+def read_messages(path):
+    stream = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    with stream:
+        for line in stream:
+            line = line.rstrip('\r\n')
+            if line:
+                yield line
+
+
 if __name__ == '__main__':
     args = parse_args()
     log = setup_logging(args.log)
-    run_client(args.host, args.port, args.message, args.timeout, args.retry,
-               log)
+    if args.input:
+        run_reliable_client(args.host, args.port, read_messages(args.input),
+                            log, args.window, args.timeout, args.retry,
+                            args.min_rto, args.unix, args.unix_mode)
+    else:
+        run_client(args.host, args.port, args.message, args.timeout,
+                   args.retry, log, args.unix, args.unix_mode)
@@ -1,7 +1,30 @@
 import argparse
+import os
+import select
+import signal
 import socket
+import time
 from loguru import logger
 import sys
+from udp_cache import ResponseCache
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'common'))
+from log_pipeline import (BackgroundWriter, LazyText,  # noqa: E402
+                          sample_messages)
+from metrics import Registry, serve_metrics  # noqa: E402
+from admission import Admission  # noqa: E402
+from profiler import MODES, StageProfiler  # noqa: E402
+from unix_socket import UnixEndpoint, peer_name, unix_supported  # noqa: E402
+from capture import TrafficCapture  # noqa: E402
+
+ACK_PREFIX = b'ACK: '
+# Linux: счётчик датаграмм, отброшенных из-за переполнения буфера приёма,
+# приходит вспомогательными данными recvmsg
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+# Ответ не доставлен: полный буфер отправки, а для Unix-сокета ещё и
+# клиент, который уже закрыл свой сокет
+SEND_ERRORS = (BlockingIOError, ConnectionRefusedError, FileNotFoundError)
 
 
 def parse_args():
@@ -18,41 +41,526 @@ def parse_args():
                         'server.log)')
     parser.add_argument('--buffer', type=int, default=1024,
                         help='Buffer size in bytes (default: 1024)')
-    return parser.parse_args()
+    parser.add_argument('--mode', choices=['simple', 'batch'],
+                        default='simple',
+                        help='One recvfrom per datagram or batched ' +
+                        'non-blocking recvmsg_into loop (default: simple)')
+    parser.add_argument('--batch', type=int, default=64,
+                        help='Datagrams drained per wake-up in batch mode ' +
+                        '(default: 64)')
+    parser.add_argument('--rcvbuf', type=int, default=None,
+                        help='SO_RCVBUF in bytes (default: system)')
+    parser.add_argument('--sndbuf', type=int, default=None,
+                        help='SO_SNDBUF in bytes (default: system)')
+    parser.add_argument('--log-mode', choices=['sync', 'async'],
+                        default='sync',
+                        help='Write logs inline or from a background thread ' +
+                        '(default: sync)')
+    parser.add_argument('--log-queue', type=int, default=10000,
+                        help='Max records waiting for the background log ' +
+                        'writer, extra records are dropped (default: 10000)')
+    parser.add_argument('--log-sample', type=int, default=1,
+                        help='Log only every N-th per-message record ' +
+                        '(default: 1)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port ' +
+                        '(default: disabled)')
+    parser.add_argument('--metrics-host', type=str, default='127.0.0.1',
+                        help='Metrics endpoint address (default: 127.0.0.1)')
+    parser.add_argument('--metrics-interval', type=float, default=0,
+                        help='Log a metrics summary every N seconds ' +
+                        '(default: 0, disabled)')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='Answer retransmitted datagrams from a ' +
+                        'response cache of up to N bytes (default: 0, ' +
+                        'disabled)')
+    parser.add_argument('--cache-ttl', type=float, default=30.0,
+                        help='Seconds a cached response stays valid ' +
+                        '(default: 30)')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='Datagrams per second from one IP, extra ' +
+                        'datagrams are dropped unread; 0 to disable ' +
+                        '(default: 0)')
+    parser.add_argument('--rate-burst', type=int, default=None,
+                        help='Datagrams from one IP allowed at once before ' +
+                        "--rate-limit applies (default: one second's worth)")
+    parser.add_argument('--subnet-rate-limit', type=float, default=0,
+                        help='Datagrams per second from one subnet, 0 to ' +
+                        'disable (default: 0)')
+    parser.add_argument('--subnet-burst', type=int, default=None,
+                        help='Burst for --subnet-rate-limit (default: one ' +
+                        "second's worth)")
+    parser.add_argument('--ipv4-prefix', type=int, default=24,
+                        help='Subnet prefix length for IPv4 (default: 24)')
+    parser.add_argument('--ipv6-prefix', type=int, default=64,
+                        help='Subnet prefix length for IPv6 (default: 64)')
+    parser.add_argument('--unix', type=str, default=None,
+                        help='Also receive datagrams on this Unix socket ' +
+                        'path from local clients (default: disabled)')
+    parser.add_argument('--unix-mode', type=lambda value: int(value, 8),
+                        default=0o660,
+                        help='Permissions of the Unix socket file, octal ' +
+                        '(default: 660)')
+    parser.add_argument('--capture', type=str, default=None,
+                        help='Append received datagrams with timestamps to ' +
+                        'this file for replay.py (default: disabled)')
+    parser.add_argument('--capture-buffer', type=int, default=1024 * 1024,
+                        help='Capture write buffer in bytes, events beyond ' +
+                        'two full buffers are dropped (default: 1048576)')
+    parser.add_argument('--capture-peers', type=int, default=4096,
+                        help='Client addresses tracked by the capture, the ' +
+                        'least recently active one is closed beyond this ' +
+                        '(default: 4096)')
+    parser.add_argument('--capture-sizes-only', action='store_true',
+                        help='Record datagram sizes without their contents')
+    parser.add_argument('--profile', choices=MODES, default=None,
+                        help='Allow profiling the datagram loop: SIGUSR1 ' +
+                        'starts, a second SIGUSR1 logs the per-stage time ' +
+                        'breakdown; cprofile and stacks also write a ' +
+                        '.prof or .folded file (default: disabled)')
+    parser.add_argument('--profile-sample', type=int, default=100,
+                        help='Time every N-th datagram (default: 100)')
+    parser.add_argument('--profile-output', type=str, default='udp_profile',
+                        help='Profile file prefix, PID and run number are ' +
+                        'appended (default: udp_profile)')
+    args = parser.parse_args()
+    if args.mode == 'batch' and not hasattr(socket.socket, 'recvmsg_into'):
+        parser.error('--mode batch requires recvmsg_into (Linux/macOS)')
+    if args.profile and not hasattr(signal, 'SIGUSR1'):
+        parser.error('--profile requires SIGUSR1')
+    if args.unix and not unix_supported():
+        parser.error('--unix requires Unix domain sockets')
+    if args.capture_peers < 1:
+        parser.error('--capture-peers must be at least 1')
+    return args
 
 
-def setup_logging(log_file):
+def setup_logging(log_file, mode='sync', queue_size=10000):
     logger.remove()
-    logger.add(sys.stdout, level="INFO",
+    writer = None
+    target = logger
+    if mode == 'async':
+        # Вывод, запись в файл, ротация и сжатие - в фоновом потоке
+        writer = BackgroundWriter(logger, queue_size)
+        target = writer.logger
+    target.add(sys.stdout, level="INFO",
                format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>" +
                "{level}</level> | {message}")
-    logger.add(log_file, level="DEBUG", rotation="10 MB", compression="zip")
+    target.add(log_file, level="DEBUG", rotation="10 MB", compression="zip")
+    if writer is not None:
+        writer.start(level="DEBUG")
     return logger
 
 
-def start_server(host, port, buffer_size, log):
+def tune_buffers(server_socket, rcvbuf, sndbuf, log):
+    if rcvbuf:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if sndbuf:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    if rcvbuf or sndbuf:
+        # Ядро может округлить или удвоить запрошенный размер
+        actual_rcvbuf = server_socket.getsockopt(socket.SOL_SOCKET,
+                                                 socket.SO_RCVBUF)
+        actual_sndbuf = server_socket.getsockopt(socket.SOL_SOCKET,
+                                                 socket.SO_SNDBUF)
+        log.info(f"Socket buffers: SO_RCVBUF {actual_rcvbuf}, SO_SNDBUF " +
+                 f"{actual_sndbuf}")
+
+
+class UdpMetrics:
+    def __init__(self):
+        self.registry = Registry()
+        metric = self.registry
+        self.datagrams = metric.counter('udp_datagrams_total',
+                                        'Acknowledged datagrams')
+        self.received = metric.counter('udp_received_bytes_total',
+                                       'Bytes received from clients')
+        self.sent = metric.counter('udp_sent_bytes_total',
+                                   'Bytes sent to clients')
+        self.overflow = metric.counter('udp_receive_overflow_total',
+                                       'Datagrams dropped by the kernel on ' +
+                                       'receive buffer overflow')
+        self.truncated = metric.counter('udp_truncated_total',
+                                        'Datagrams larger than the buffer')
+        self.send_dropped = metric.counter('udp_send_dropped_total',
+                                           'Replies dropped on a full send ' +
+                                           'buffer or an unreachable peer')
+        self.cache_hits = metric.counter('udp_cache_hits_total',
+                                         'Retransmissions answered from ' +
+                                         'the response cache')
+        self.cache_misses = metric.counter('udp_cache_misses_total',
+                                           'Datagrams not found in the ' +
+                                           'response cache')
+        self.refused = metric.counter('udp_admission_dropped_total',
+                                      'Datagrams dropped by per-address ' +
+                                      'rate limits')
+        self.service_time = metric.histogram(
+            'udp_service_seconds', 'Time from receiving a datagram to ' +
+            'sending its ACK')
+
+    def datagram(self, size, started):
+        self.datagrams.inc()
+        self.received.inc(size)
+        self.sent.inc(size + len(ACK_PREFIX))
+        self.service_time.observe((time.perf_counter_ns() - started) / 1e9)
+
+
+def send_reply(server_socket, data, addr, tag=b''):
+    if hasattr(server_socket, 'sendmsg'):
+        server_socket.sendmsg([ACK_PREFIX, tag, data], [], 0, addr)
+    else:  # Windows
+        server_socket.sendto(ACK_PREFIX + tag + data, addr)
+
+
+def reply_from_cache(server_socket, cache, data, addr, started,
+                     metrics=None):
+    # Повтор уже обработанного запроса получает сохранённый ответ; иначе
+    # возвращается (ключ, длина тега), чтобы сохранить ответ после
+    # обработки
+    key, tag_size, response = cache.lookup(addr, data)
+    if response is None:
+        if metrics is not None:
+            metrics.cache_misses.inc()
+        return key, tag_size
+    send_reply(server_socket, response, addr, data[:tag_size])
+    if metrics is not None:
+        metrics.cache_hits.inc()
+        metrics.datagram(len(data), started)
+    return None
+
+
+def remember_reply(cache, key, tag_size, data):
+    # Эхо-ответ совпадает с сообщением (без номера - с ключом), поэтому
+    # храним один объект
+    if tag_size:
+        message = bytes(data[tag_size:])
+        cache.store(key, message, message)
+    else:
+        cache.store(key, key[1])
+
+
+def unix_peer(addr, log):
+    # Адрес для логов в виде (имя, порт), как у IP-клиента. Клиенту без
+    # привязанного к пути сокета ответить некуда - возвращается None
+    if not addr:
+        log.debug("Dropped a datagram from an unbound Unix socket")
+        return None
+    return peer_name(addr), 0
+
+
+def reply_dropped(error, local, peer, log):
+    # Ответ одному клиенту не доставлен, сервер продолжает работу. Через
+    # Unix-сокет любая ошибка отправки касается только адресата (например,
+    # нет прав на файл его сокета); остальные ошибки UDP-сокета
+    # пробрасываются
+    if not local and not isinstance(error, SEND_ERRORS):
+        return False
+    if not isinstance(error, SEND_ERRORS):
+        log.warning(f"Reply to {peer[0]} dropped: {error}")
+    return True
+
+
+def report_shutdown(log, cache=None, admission=None):
+    if cache is not None:
+        log.info(f"Response cache: {cache.summary()}")
+    if admission is not None:
+        log.info(f"Admission: {admission.summary()}")
+
+
+def start_server(host, port, buffer_size, log, msg_log=None, rcvbuf=None,
+                 sndbuf=None, metrics=None, cache=None, admission=None,
+                 profiler=None, unix=None, capture=None):
+    msg_log = msg_log or log
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
+        tune_buffers(server_socket, rcvbuf, sndbuf, log)
         server_socket.bind((host, port))
+        sockets = [server_socket]
+        if unix is not None:
+            # Неблокирующий: занятый или ушедший локальный клиент не должен
+            # останавливать сервер на отправке ответа
+            unix.socket.setblocking(False)
+            sockets.append(unix.socket)
+            log.info(f"Also receiving on {unix.name}")
         log.info(
             f"UDP Server started on {host}:{port}. Waiting for datagrams...")
 
         try:
+            buffer = memoryview(bytearray(buffer_size))
             while True:
-                data, addr = server_socket.recvfrom(buffer_size)
-                message = data.decode('utf-8')
-                log.info(f"Received from {addr[0]}:{addr[1]}: {message}")
-
-                # Эхо-ответ
-                response = f"ACK: {message}"
-                server_socket.sendto(response.encode('utf-8'), addr)
-                log.debug(f"Sent response to {addr[0]}:{addr[1]}")
+                receiving = server_socket
+                if unix is not None:
+                    # Сокеты по очереди, чтобы ни один не ждал другого
+                    receiving = select.select(sockets, [], [])[0][0]
+                    sockets.reverse()
+                probe = profiler.probe() if profiler is not None else None
+                try:
+                    size, addr = receiving.recvfrom_into(buffer)
+                except BlockingIOError:
+                    continue
+                started = time.perf_counter_ns()
+                if probe is not None:
+                    probe.mark('recv')
+                peer = addr
+                if receiving is not server_socket:
+                    peer = unix_peer(addr, log)
+                    if peer is None:
+                        continue
+                # Лишние датаграммы отбрасываются до разбора и логирования
+                elif (admission is not None and
+                        admission.admit(addr[0]) is not None):
+                    if metrics is not None:
+                        metrics.refused.inc()
+                    continue
+                data = buffer[:size]
+                if capture is not None:
+                    # Повторы тоже записываются: это часть трафика
+                    stream = capture.stream(addr)
+                    stream.received(data, started)
+                try:
+                    if cache is not None:
+                        pending = reply_from_cache(receiving, cache, data,
+                                                   addr, started, metrics)
+                        if pending is None:
+                            if capture is not None:
+                                stream.sent()
+                            if probe is not None:
+                                probe.mark('cached')
+                                profiler.record(probe)
+                            continue
+                    if probe is not None:
+                        probe.mark('filter')
+                    msg_log.info("Received from {}:{}: {}", peer[0], peer[1],
+                                 LazyText(data))
+                    if probe is not None:
+                        probe.mark('log')
+
+                    # Эхо-ответ: префикс и исходный буфер без decode/encode
+                    send_reply(receiving, data, addr)
+                except OSError as e:
+                    if not reply_dropped(e, receiving is not server_socket,
+                                         peer, log):
+                        raise
+                    if metrics is not None:
+                        metrics.send_dropped.inc()
+                    continue
+                if capture is not None:
+                    stream.sent()
+                if probe is not None:
+                    probe.mark('send')
+                if cache is not None:
+                    remember_reply(cache, *pending, data)
+                if probe is not None:
+                    probe.mark('cache')
+                msg_log.debug("Sent response to {}:{}", peer[0], peer[1])
+                if probe is not None:
+                    probe.mark('log')
+                if metrics is not None:
+                    metrics.datagram(size, started)
+                if probe is not None:
+                    probe.mark('metrics')
+                    profiler.record(probe)
         except KeyboardInterrupt:
             log.info("Server shutdown by administrator")
+            report_shutdown(log, cache, admission)
+        except Exception as e:
+            log.error(f"Unexpected error: {str(e)}")
+
+
+def start_batch_server(host, port, buffer_size, log, msg_log=None,
+                       batch=64, rcvbuf=None, sndbuf=None,
+                       report_interval=10.0, metrics=None, cache=None,
+                       admission=None, profiler=None, unix=None,
+                       capture=None):
+    msg_log = msg_log or log
+    # Буферы выделяются один раз и переиспользуются для каждой пачки
+    views = [memoryview(bytearray(buffer_size)) for _ in range(batch)]
+    received = [None] * batch
+    ancbufsize = socket.CMSG_SPACE(4)
+    overflow = truncated = send_dropped = 0
+    reported_overflow = 0
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
+        tune_buffers(server_socket, rcvbuf, sndbuf, log)
+        try:
+            server_socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        except OSError:
+            log.warning("SO_RXQ_OVFL is not supported, receive buffer " +
+                        "drops will not be counted")
+        server_socket.bind((host, port))
+        server_socket.setblocking(False)
+        sockets = [server_socket]
+        if unix is not None:
+            unix.socket.setblocking(False)
+            sockets.append(unix.socket)
+            log.info(f"Also receiving on {unix.name}")
+        log.info(f"UDP batch server started on {host}:{port} (batch " +
+                 f"{batch}). Waiting for datagrams...")
+
+        report_at = time.monotonic() + report_interval
+        try:
+            while True:
+                ready = select.select(sockets, [], [], report_interval)[0]
+                # Первым в следующий раз вычитывается другой сокет
+                sockets.reverse()
+
+                # Вычитываем всё, что накопилось, но не больше batch
+                count = 0
+                for receiving in ready:
+                    while count < batch:
+                        try:
+                            size, ancdata, flags, addr = \
+                                receiving.recvmsg_into([views[count]],
+                                                       ancbufsize)
+                        except BlockingIOError:
+                            break
+                        for level, kind, data in ancdata:
+                            if (level == socket.SOL_SOCKET and
+                                    kind == SO_RXQ_OVFL):
+                                total = int.from_bytes(data[:4],
+                                                       sys.byteorder)
+                                if metrics is not None and total > overflow:
+                                    metrics.overflow.inc(total - overflow)
+                                overflow = total
+                        if flags & socket.MSG_TRUNC:
+                            truncated += 1
+                            if metrics is not None:
+                                metrics.truncated.inc()
+                        received[count] = (size, addr, receiving)
+                        count += 1
+                started = time.perf_counter_ns()
+                now = time.monotonic()
+
+                # Ответ собирается из префикса и исходного буфера без
+                # decode/encode
+                for i in range(count):
+                    # В пачке recv не разделить по датаграммам: замер
+                    # начинается с обработки
+                    probe = profiler.probe() if profiler is not None else None
+                    size, addr, receiving = received[i]
+                    peer = addr
+                    if receiving is not server_socket:
+                        peer = unix_peer(addr, log)
+                        if peer is None:
+                            continue
+                    elif (admission is not None and
+                            admission.admit(addr[0], now) is not None):
+                        if metrics is not None:
+                            metrics.refused.inc()
+                        continue
+                    payload = views[i][:size]
+                    if capture is not None:
+                        stream = capture.stream(addr)
+                        stream.received(payload, started)
+                    try:
+                        if cache is not None:
+                            pending = reply_from_cache(receiving, cache,
+                                                       payload, addr,
+                                                       started, metrics)
+                            if pending is None:
+                                if capture is not None:
+                                    stream.sent()
+                                if probe is not None:
+                                    probe.mark('cached')
+                                    profiler.record(probe)
+                                continue
+                        if probe is not None:
+                            probe.mark('filter')
+                        msg_log.info("Received from {}:{}: {}", peer[0],
+                                     peer[1], LazyText(payload))
+                        if probe is not None:
+                            probe.mark('log')
+                        send_reply(receiving, payload, addr)
+                    except OSError as e:
+                        if not reply_dropped(e, receiving is not
+                                             server_socket, peer, log):
+                            raise
+                        send_dropped += 1
+                        if metrics is not None:
+                            metrics.send_dropped.inc()
+                        continue
+                    if capture is not None:
+                        stream.sent()
+                    if probe is not None:
+                        probe.mark('send')
+                    if cache is not None:
+                        remember_reply(cache, *pending, payload)
+                    if probe is not None:
+                        probe.mark('cache')
+                    msg_log.debug("Sent response to {}:{}", peer[0], peer[1])
+                    if probe is not None:
+                        probe.mark('log')
+                    if metrics is not None:
+                        metrics.datagram(size, started)
+                    if probe is not None:
+                        probe.mark('metrics')
+                        profiler.record(probe)
+
+                if time.monotonic() >= report_at:
+                    if overflow > reported_overflow or truncated or \
+                            send_dropped:
+                        log.warning("Dropped datagrams: " +
+                                    f"{overflow - reported_overflow} receive "
+                                    f"buffer overflow, {truncated} truncated, "
+                                    f"{send_dropped} replies not delivered")
+                        reported_overflow = overflow
+                        truncated = send_dropped = 0
+                    report_at = time.monotonic() + report_interval
+        except KeyboardInterrupt:
+            log.info("Server shutdown by administrator, " +
+                     f"{overflow} datagrams dropped on receive overflow")
+            report_shutdown(log, cache, admission)
         except Exception as e:
             log.error(f"Unexpected error: {str(e)}")
 
 
 if __name__ == '__main__':
     args = parse_args()
-    log = setup_logging(args.log)
-    start_server(args.host, args.port, args.buffer, log)
+    log = setup_logging(args.log, args.log_mode, args.log_queue)
+    msg_log = sample_messages(log, args.log_sample)
+    metrics = None
+    if args.metrics_port or args.metrics_interval:
+        metrics = UdpMetrics()
+        serve_metrics(metrics.registry, log, args.metrics_host,
+                      args.metrics_port, args.metrics_interval)
+    cache = None
+    if args.cache_size:
+        cache = ResponseCache(args.cache_size, args.cache_ttl)
+    admission = None
+    if args.rate_limit or args.subnet_rate_limit:
+        admission = Admission(args.rate_limit, args.rate_burst,
+                              args.subnet_rate_limit, args.subnet_burst,
+                              ipv4_prefix=args.ipv4_prefix,
+                              ipv6_prefix=args.ipv6_prefix)
+    profiler = None
+    if args.profile:
+        profiler = StageProfiler(log, args.profile_sample, args.profile,
+                                 args.profile_output)
+        profiler.install()
+        log.info(f"Profiler ready, send SIGUSR1 to process {os.getpid()} " +
+                 "to start")
+    unix = None
+    if args.unix:
+        unix = UnixEndpoint(args.unix, socket.SOCK_DGRAM, args.unix_mode)
+    capture = None
+    if args.capture:
+        capture = TrafficCapture(args.capture, 'udp', args.capture_buffer,
+                                 not args.capture_sizes_only,
+                                 max_peers=args.capture_peers)
+        log.info(f"Capturing traffic to {args.capture}")
+    try:
+        if args.mode == 'batch':
+            start_batch_server(args.host, args.port, args.buffer, log,
+                               msg_log, args.batch, args.rcvbuf, args.sndbuf,
+                               metrics=metrics, cache=cache,
+                               admission=admission, profiler=profiler,
+                               unix=unix, capture=capture)
+        else:
+            start_server(args.host, args.port, args.buffer, log, msg_log,
+                         args.rcvbuf, args.sndbuf, metrics, cache, admission,
+                         profiler, unix, capture)
+    finally:
+        if capture is not None:
+            capture.close()
+            log.info(f"Capture: {capture.summary()}")
+        if unix is not None:
+            unix.close()
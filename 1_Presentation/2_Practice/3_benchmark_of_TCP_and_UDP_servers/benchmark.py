@@ -0,0 +1,382 @@
+import argparse
+from datetime import datetime, timezone
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import threading
+import time
+from loguru import logger
+import sys
+
+PRACTICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [
+    os.path.join(PRACTICE_DIR, '1_implementation_of_TCP_client_and_TCP_serv' +
+                 'er'),
+    os.path.join(PRACTICE_DIR, '2_UDP_client_and_UDP_server_implementation'),
+]
+import tcp_server  # noqa: E402
+import udp_server  # noqa: E402
+from tcp_framing import FrameReader, send_frame  # noqa: E402
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='TCP/UDP echo benchmark')
+    parser.add_argument('--target', choices=['tcp', 'udp'], default='tcp',
+                        help='Service to benchmark (default: tcp)')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Server IP address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='Server port (default: 5000)')
+    parser.add_argument('--no-spawn', action='store_true',
+                        help='Use an already running server instead of ' +
+                        'starting start_server in a child process')
+    parser.add_argument('--server-mode', choices=['blocking', 'async'],
+                        default='async',
+                        help='TCP server mode when spawned (default: async)')
+    parser.add_argument('--udp-mode', choices=['simple', 'batch'],
+                        default='simple',
+                        help='UDP server mode when spawned (default: simple)')
+    parser.add_argument('--protocol', choices=['raw', 'framed'],
+                        default='framed',
+                        help='TCP wire protocol (default: framed)')
+    parser.add_argument('--buffer', type=int, default=65507,
+                        help='UDP server buffer size when spawned ' +
+                        '(default: 65507)')
+    parser.add_argument('--server-log', type=str, default=os.devnull,
+                        help='Log file of the spawned server (default: ' +
+                        'discarded)')
+    parser.add_argument('--server-log-level', type=str, default='INFO',
+                        help='Log level of the spawned server (default: INFO)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Parallel connections/sockets (default: 8)')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='Measurement time in seconds (default: 10.0)')
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help='Warm-up time not counted in results ' +
+                        '(default: 1.0)')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='Total requests/s for open-loop load, 0 for ' +
+                        'closed loop (default: 0)')
+    parser.add_argument('--size', type=str, default='64',
+                        help='Message size: N, MIN-MAX (uniform) or ' +
+                        'N1,N2,... (random choice) (default: 64)')
+    parser.add_argument('--timeout', type=float, default=2.0,
+                        help='Response timeout in seconds (default: 2.0)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed for message sizes (default: 1)')
+    parser.add_argument('--json', type=str,
+                        help='Write results to this JSON file')
+    parser.add_argument('--baseline', type=str,
+                        help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Allowed regression against --baseline in ' +
+                        'percent (default: 10.0)')
+    return parser.parse_args()
+
+
+def setup_logging():
+    logger.remove()
+    logger.add(sys.stdout, level="INFO",
+               format="<cyan>{time:YYYY-MM-DD HH:mm:ss}</cyan> | <level>" +
+               "{level}</level> | {message}")
+    return logger
+
+
+def parse_sizes(spec):
+    if '-' in spec:
+        low, high = (int(part) for part in spec.split('-', 1))
+        return lambda rng: rng.randint(low, high)
+    choices = [int(part) for part in spec.split(',')]
+    return lambda rng: rng.choice(choices)
+
+
+def make_payloads(spec, seed, count=1024):
+    # Сообщения готовятся заранее, чтобы генерация не попадала в замер
+    rng = random.Random(seed)
+    next_size = parse_sizes(spec)
+    letters = b'abcdefghijklmnopqrstuvwxyz'
+    return [bytes(rng.choice(letters) for _ in range(next_size(rng)))
+            for _ in range(count)]
+
+
+def run_server(args):
+    logger.remove()
+    logger.add(args.server_log, level=args.server_log_level)
+    if args.target == 'udp' and args.udp_mode == 'batch':
+        udp_server.start_batch_server(args.host, args.port, args.buffer,
+                                      logger)
+    elif args.target == 'udp':
+        udp_server.start_server(args.host, args.port, args.buffer, logger)
+    elif args.server_mode == 'async':
+        tcp_server.start_async_server(args.host, args.port, logger,
+                                      protocol=args.protocol)
+    else:
+        tcp_server.start_server(args.host, args.port, logger,
+                                backlog=socket.SOMAXCONN,
+                                protocol=args.protocol)
+
+
+def wait_for_server(args, deadline=5.0):
+    if args.target == 'udp':
+        time.sleep(0.5)
+        return
+    stop = time.monotonic() + deadline
+    while time.monotonic() < stop:
+        try:
+            socket.create_connection((args.host, args.port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start on {args.host}:{args.port}")
+
+
+class TcpSession:
+    def __init__(self, host, port, protocol, timeout):
+        self.socket = socket.create_connection((host, port), timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.protocol = protocol
+        self.reader = FrameReader(self.socket)
+
+    def request(self, payload):
+        expected = len(payload) + 6
+        if self.protocol == 'framed':
+            send_frame(self.socket, payload)
+            response = self.reader.read_frame()
+            if response is None:
+                raise ConnectionResetError("Server closed the connection")
+        else:
+            # Без кадров ответ может прийти частями: читаем до полной длины
+            self.socket.sendall(payload)
+            response = b''
+            while len(response) < expected:
+                chunk = self.socket.recv(65536)
+                if not chunk:
+                    raise ConnectionResetError("Server closed the " +
+                                               "connection")
+                response += chunk
+        if len(response) != expected or response[:6] != b'ECHO: ':
+            raise ValueError("Unexpected response")
+
+    def close(self):
+        self.socket.close()
+
+
+class UdpSession:
+    def __init__(self, host, port, timeout):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect((host, port))
+
+    def request(self, payload):
+        self.socket.send(payload)
+        response = self.socket.recv(65536)
+        if len(response) != len(payload) + 5 or response[:5] != b'ACK: ':
+            raise ValueError("Unexpected response")
+
+    def close(self):
+        self.socket.close()
+
+
+def open_session(args):
+    if args.target == 'udp':
+        return UdpSession(args.host, args.port, args.timeout)
+    return TcpSession(args.host, args.port, args.protocol, args.timeout)
+
+
+def error_name(error):
+    if isinstance(error, socket.timeout):
+        return 'timeout'
+    return type(error).__name__
+
+
+def run_worker(args, index, payloads, start, measure_from, stop, result):
+    latencies = result['latencies']
+    errors = result['errors']
+    interval = args.concurrency / args.rate if args.rate else 0.0
+    # Открытая нагрузка: запросы идут по расписанию, задержка считается от
+    # запланированного момента (без coordinated omission)
+    scheduled = start + index * interval / args.concurrency
+    session = None
+    i = index
+    while True:
+        now = time.perf_counter()
+        if now >= stop:
+            break
+        if interval:
+            if scheduled > now:
+                time.sleep(scheduled - now)
+            started = scheduled
+            scheduled += interval
+        else:
+            started = now
+        if started >= stop:
+            break
+
+        payload = payloads[i % len(payloads)]
+        i += 1
+        try:
+            if session is None:
+                session = open_session(args)
+            session.request(payload)
+        except (OSError, ValueError) as e:
+            if started >= measure_from:
+                name = error_name(e)
+                errors[name] = errors.get(name, 0) + 1
+            # Новое соединение после ошибки; для UDP - новый сокет с
+            # другим портом, чтобы опоздавший ответ не засчитался
+            # следующему запросу
+            if session is not None:
+                session.close()
+                session = None
+            continue
+        if started >= measure_from:
+            latencies.append(time.perf_counter() - started)
+            result['bytes'] += len(payload)
+    if session is not None:
+        session.close()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1,
+                int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def histogram(sorted_values):
+    # Логарифмические корзины по степеням двойки в микросекундах
+    buckets = {}
+    for value in sorted_values:
+        bound = 1
+        micros = value * 1e6
+        while bound < micros:
+            bound *= 2
+        buckets[bound] = buckets.get(bound, 0) + 1
+    return [{'le_us': bound, 'count': count}
+            for bound, count in sorted(buckets.items())]
+
+
+def run_benchmark(args, log):
+    payloads = make_payloads(args.size, args.seed)
+    start = time.perf_counter()
+    measure_from = start + args.warmup
+    stop = measure_from + args.duration
+    results = [{'latencies': [], 'errors': {}, 'bytes': 0}
+               for _ in range(args.concurrency)]
+    threads = [threading.Thread(target=run_worker,
+                                args=(args, index, payloads, start,
+                                      measure_from, stop, results[index]),
+                                daemon=True)
+               for index in range(args.concurrency)]
+    log.info(f"Benchmarking {args.target} {args.host}:{args.port}: " +
+             f"{args.concurrency} workers, " +
+             (f"open loop {args.rate} req/s" if args.rate else "closed loop") +
+             f", {args.duration}s after {args.warmup}s warm-up")
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies = sorted(value for result in results
+                       for value in result['latencies'])
+    errors = {}
+    for result in results:
+        for name, count in result['errors'].items():
+            errors[name] = errors.get(name, 0) + count
+    completed = len(latencies)
+    return {
+        'requests': completed,
+        'errors': errors,
+        'throughput_rps': completed / args.duration,
+        'throughput_mbps': (sum(result['bytes'] for result in results) /
+                            args.duration / 1e6),
+        'latency_ms': {
+            **{f'p{p:g}': percentile(latencies, p) * 1000
+               for p in PERCENTILES},
+            'mean': sum(latencies) / completed * 1000 if completed else 0.0,
+            'max': latencies[-1] * 1000 if completed else 0.0,
+        },
+        'histogram': histogram(latencies),
+    }
+
+
+def report(results, log):
+    latency = results['latency_ms']
+    log.info(f"Requests: {results['requests']}, throughput " +
+             f"{results['throughput_rps']:.1f} req/s " +
+             f"({results['throughput_mbps']:.3f} MB/s)")
+    log.info("Latency ms: " + ", ".join(f"{name} {value:.3f}"
+                                        for name, value in latency.items()))
+    total_errors = sum(results['errors'].values())
+    if total_errors:
+        log.warning(f"Errors: {total_errors} {results['errors']}")
+
+
+def compare(results, baseline, threshold, log):
+    # Регрессия: пропускная способность ниже или хвост задержек выше
+    # базового прогона больше чем на threshold процентов
+    regressions = []
+    old = baseline['results']
+    checks = [('throughput_rps', old['throughput_rps'],
+               results['throughput_rps'], -1)]
+    for name in ('p50', 'p99', 'p99.9'):
+        checks.append((f'latency {name}', old['latency_ms'][name],
+                       results['latency_ms'][name], 1))
+    for name, before, after, direction in checks:
+        change = (after - before) / before * 100 if before else 0.0
+        log.info(f"{name}: {before:.3f} -> {after:.3f} ({change:+.1f}%)")
+        if change * direction > threshold:
+            regressions.append(name)
+    if regressions:
+        log.error(f"Regression over {threshold}%: {', '.join(regressions)}")
+    return not regressions
+
+
+def main():
+    args = parse_args()
+    log = setup_logging()
+
+    server = None
+    if not args.no_spawn:
+        server = multiprocessing.Process(target=run_server, args=(args,),
+                                         daemon=True)
+        server.start()
+        wait_for_server(args)
+    try:
+        results = run_benchmark(args, log)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    report(results, log)
+    document = {
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('json', 'baseline')},
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(document, json_file, indent=2)
+        log.info(f"Results written to {args.json}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        if not compare(results, baseline, args.threshold, log):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+import argparse
+import asyncio
+from collections import deque
+import json
+import multiprocessing
+import os
+import time
+from loguru import logger
+import sys
+
+import benchmark
+sys.path.append(os.path.join(benchmark.PRACTICE_DIR, 'common'))
+from capture import CLOSE, DATA, SENT, read_runs  # noqa: E402
+from tcp_framing import read_frame_async, write_frame_async  # noqa: E402
+
+ECHO_PREFIX = b'ECHO: '
+ACK_PREFIX = b'ACK: '
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay captured traffic ' +
+                                     'against the TCP/UDP server')
+    parser.add_argument('capture', type=str,
+                        help='File written by the server with --capture')
+    parser.add_argument('--run', type=int, default=-1,
+                        help='Server run in the file to replay, 0 is the ' +
+                        'first (default: -1, the last)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed factor, e.g. 10 for ten times ' +
+                        'faster; 0 sends every message as soon as the ' +
+                        'previous one on its connection is answered ' +
+                        '(default: 1)')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Server IP address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='Server port (default: 5000)')
+    parser.add_argument('--no-spawn', action='store_true',
+                        help='Use an already running server instead of ' +
+                        'starting start_server in a child process')
+    parser.add_argument('--server-mode', choices=['blocking', 'async'],
+                        default='async',
+                        help='TCP server mode when spawned (default: async)')
+    parser.add_argument('--udp-mode', choices=['simple', 'batch'],
+                        default='simple',
+                        help='UDP server mode when spawned (default: simple)')
+    parser.add_argument('--buffer', type=int, default=65507,
+                        help='UDP server buffer size when spawned ' +
+                        '(default: 65507)')
+    parser.add_argument('--server-log', type=str, default=os.devnull,
+                        help='Log file of the spawned server (default: ' +
+                        'discarded)')
+    parser.add_argument('--server-log-level', type=str, default='INFO',
+                        help='Log level of the spawned server (default: INFO)')
+    parser.add_argument('--max-connections', type=int, default=500,
+                        help='Connections open at once, later ones wait ' +
+                        '(default: 500)')
+    parser.add_argument('--timeout', type=float, default=2.0,
+                        help='Seconds to wait for outstanding responses ' +
+                        'before closing a connection (default: 2.0)')
+    parser.add_argument('--json', type=str,
+                        help='Write results to this JSON file')
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error('--speed must not be negative')
+    return args
+
+
+def setup_logging():
+    logger.remove()
+    logger.add(sys.stdout, level="INFO",
+               format="<cyan>{time:YYYY-MM-DD HH:mm:ss}</cyan> | <level>" +
+               "{level}</level> | {message}")
+    return logger
+
+
+def load_connections(events):
+    # Соединения в порядке открытия: {'open': нс, 'close': нс или None,
+    # 'messages': [[нс, длина, данные или None, исходная задержка нс]]}.
+    # Сервер отвечает по порядку, поэтому ответ (SENT) относится к самому
+    # старому сообщению соединения без ответа
+    connections = {}
+    unanswered = {}
+    for kind, stream_id, at, size, payload in events:
+        connection = connections.get(stream_id)
+        if connection is None:
+            connection = connections[stream_id] = {
+                'open': at, 'close': None, 'messages': []}
+            unanswered[stream_id] = deque()
+        if kind == DATA:
+            message = [at, size, payload, None]
+            connection['messages'].append(message)
+            unanswered[stream_id].append(message)
+        elif kind == SENT and unanswered[stream_id]:
+            message = unanswered[stream_id].popleft()
+            message[3] = at - message[0]
+        elif kind == CLOSE:
+            connection['close'] = at
+    return sorted(connections.values(), key=lambda item: item['open'])
+
+
+class Exchange:
+    # Запросы одного соединения, ждущие ответа, в порядке отправки
+
+    def __init__(self, results):
+        self.results = results
+        self.waiting = deque()
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def sent(self, expected, original):
+        self.waiting.append((time.perf_counter(), expected, original))
+        self.idle.clear()
+
+    def answered(self, response=None, prefix=None):
+        sent_at, _, original = self.waiting.popleft()
+        self.results['pairs'].append((time.perf_counter() - sent_at,
+                                      original))
+        if prefix is not None and not response.startswith(prefix):
+            self.results['mismatched'] += 1
+        if not self.waiting:
+            self.idle.set()
+
+
+class Replay:
+    def __init__(self, args, protocol):
+        self.args = args
+        self.protocol = protocol
+        self.slots = asyncio.Semaphore(args.max_connections)
+        self.results = {'pairs': [], 'lag': [], 'errors': {}, 'lost': 0,
+                        'mismatched': 0}
+        self.start = None
+
+    async def wait_until(self, at):
+        # Время события в записи -> момент отправки при воспроизведении
+        if not self.args.speed:
+            return
+        due = self.start + at / 1e9 / self.args.speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.results['lag'].append(max(time.perf_counter() - due, 0.0))
+
+    def error(self, error):
+        name = benchmark.error_name(error)
+        self.results['errors'][name] = self.results['errors'].get(name,
+                                                                  0) + 1
+
+    async def connection(self, recorded):
+        await self.wait_until(recorded['open'])
+        async with self.slots:
+            try:
+                if self.protocol == 'udp':
+                    await self.replay_udp(recorded)
+                else:
+                    await self.replay_tcp(recorded)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                self.error(e)
+
+    async def wait_answers(self, exchange):
+        try:
+            await asyncio.wait_for(exchange.idle.wait(), self.args.timeout)
+        except asyncio.TimeoutError:
+            self.results['lost'] += len(exchange.waiting)
+            exchange.waiting.clear()
+            exchange.idle.set()
+
+    async def send_all(self, recorded, exchange, send):
+        for at, size, payload, original in recorded['messages']:
+            await self.wait_until(at)
+            # Без сохранённого содержимого - заполнитель той же длины
+            payload = payload if payload is not None else b'x' * size
+            exchange.sent(len(payload), original)
+            await send(payload)
+            if not self.args.speed:
+                await self.wait_answers(exchange)
+        await self.wait_answers(exchange)
+        if recorded['close'] is not None:
+            await self.wait_until(recorded['close'])
+
+    async def replay_tcp(self, recorded):
+        reader, writer = await asyncio.open_connection(self.args.host,
+                                                       self.args.port)
+        exchange = Exchange(self.results)
+        framed = self.protocol == 'tcp-framed'
+
+        async def receive():
+            received = 0
+            while True:
+                if framed:
+                    frame = await read_frame_async(reader)
+                    if frame is None:
+                        return
+                    exchange.answered(frame, ECHO_PREFIX)
+                    continue
+                # Без кадров ответы могут склеиться или прийти частями:
+                # считаем байты
+                chunk = await reader.read(65536)
+                if not chunk:
+                    return
+                received += len(chunk)
+                while (exchange.waiting and received >=
+                       exchange.waiting[0][1] + len(ECHO_PREFIX)):
+                    received -= exchange.waiting[0][1] + len(ECHO_PREFIX)
+                    exchange.answered()
+
+        async def send(payload):
+            if framed:
+                write_frame_async(writer, payload)
+            else:
+                writer.write(payload)
+            await writer.drain()
+
+        receiver = asyncio.create_task(receive())
+        try:
+            await self.send_all(recorded, exchange, send)
+        finally:
+            receiver.cancel()
+            writer.close()
+
+    async def replay_udp(self, recorded):
+        exchange = Exchange(self.results)
+        loop = asyncio.get_running_loop()
+
+        class Client(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                if exchange.waiting:
+                    exchange.answered(data, ACK_PREFIX)
+
+        transport, _ = await loop.create_datagram_endpoint(
+            Client, remote_addr=(self.args.host, self.args.port))
+
+        async def send(payload):
+            transport.sendto(payload)
+
+        try:
+            await self.send_all(recorded, exchange, send)
+        finally:
+            transport.close()
+
+    async def run(self, connections):
+        self.start = time.perf_counter()
+        await asyncio.gather(*(self.connection(recorded)
+                               for recorded in connections))
+        return time.perf_counter() - self.start
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {**{f'p{p:g}': benchmark.percentile(values, p) * 1000
+               for p in benchmark.PERCENTILES},
+            'max': values[-1] * 1000}
+
+
+def report(results, log):
+    original = summarize(original / 1e9 for _, original in results['pairs']
+                         if original is not None)
+    replayed = summarize(latency for latency, _ in results['pairs'])
+    names = list(replayed)
+    log.info(f"{'Latency ms':<18}" + "".join(f"{name:>10}" for name in names))
+    log.info(f"{'  original server':<18}" +
+             "".join(f"{original.get(name, 0.0):>10.3f}" for name in names))
+    log.info(f"{'  replay client':<18}" +
+             "".join(f"{replayed[name]:>10.3f}" for name in names))
+    log.info(f"{'  difference':<18}" +
+             "".join(f"{replayed[name] - original.get(name, 0.0):>+10.3f}"
+                     for name in names))
+    # Задержка в записи - время обработки на сервере, при воспроизведении
+    # к нему добавляются сеть и клиент
+    log.info("(original: server receive to reply; replay: client send to " +
+             "response)")
+    lag = summarize(results['lag'])
+    if lag:
+        log.info("Schedule lag ms: " + ", ".join(
+            f"{name} {value:.3f}" for name, value in lag.items()))
+    problems = sum(results['errors'].values())
+    if problems or results['lost'] or results['mismatched']:
+        log.warning(f"Errors: {problems} {results['errors']}, " +
+                    f"{results['lost']} responses lost, " +
+                    f"{results['mismatched']} unexpected")
+    return {'original_ms': original, 'replay_ms': replayed, 'lag_ms': lag}
+
+
+def main():
+    args = parse_args()
+    log = setup_logging()
+
+    runs = read_runs(args.capture)
+    if not runs:
+        log.error(f"No runs in {args.capture}")
+        sys.exit(1)
+    run = runs[args.run]
+    connections = load_connections(run['events'])
+    messages = sum(len(recorded['messages']) for recorded in connections)
+    if not messages:
+        log.error("Nothing to replay")
+        sys.exit(1)
+    # Простой до первого соединения не воспроизводится
+    first = connections[0]['open']
+    for recorded in connections:
+        recorded['open'] -= first
+        if recorded['close'] is not None:
+            recorded['close'] -= first
+        for message in recorded['messages']:
+            message[0] -= first
+    duration = max(max([recorded['open'], recorded['close'] or 0] +
+                       [message[0] for message in recorded['messages']])
+                   for recorded in connections) / 1e9
+    log.info(f"{len(runs)} runs in {args.capture}, replaying " +
+             f"{run['protocol']} run of PID {run['pid']}: " +
+             f"{len(connections)} connections, {messages} messages over " +
+             f"{duration:.3f}s at " +
+             (f"{args.speed:g}x" if args.speed else "maximum speed"))
+
+    # Сервер запускается с протоколом записи
+    args.target = 'udp' if run['protocol'] == 'udp' else 'tcp'
+    args.protocol = 'framed' if run['protocol'] == 'tcp-framed' else 'raw'
+    server = None
+    if not args.no_spawn:
+        server = multiprocessing.Process(target=benchmark.run_server,
+                                         args=(args,), daemon=True)
+        server.start()
+        benchmark.wait_for_server(args)
+    try:
+        replay = Replay(args, run['protocol'])
+        elapsed = asyncio.run(replay.run(connections))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    results = replay.results
+    log.info(f"Replayed {len(results['pairs'])} of {messages} messages in " +
+             f"{elapsed:.3f}s (original {duration:.3f}s)")
+    summary = report(results, log)
+    if args.json:
+        document = {
+            'capture': args.capture,
+            'run': {'protocol': run['protocol'], 'pid': run['pid'],
+                    'connections': len(connections), 'messages': messages,
+                    'duration_s': duration},
+            'speed': args.speed,
+            'elapsed_s': elapsed,
+            'replayed': len(results['pairs']),
+            'errors': results['errors'],
+            'lost': results['lost'],
+            'mismatched': results['mismatched'],
+            **summary,
+        }
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(document, json_file, indent=2)
+        log.info(f"Results written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+import gzip
+import json
+import mmap
+import os
+import re
+import zipfile
+from loguru import logger
+import sys
+
+# Запись loguru в файле: "2025-06-24 21:10:27.317 | INFO     | __main__:
+# start_server:53 - сообщение"; в выводе на консоль нет имени функции и
+# время в ISO-формате. Ключ минуты - "YYYY-MM-DD HH:MM"
+RECORD = re.compile(rb'^(\d{4}-\d\d-\d\d[ T]\d\d:\d\d):\d\d\S* \| ' +
+                    rb'([A-Z]+) *\| (?:[\w.<>]+:[\w.<>]+:\d+ - )?' +
+                    rb'([^\r\n]*)', re.M)
+# TCP пишет адрес кортежем ('ip', port), UDP - как ip:port
+RECEIVED = re.compile(rb"Received from (?:\('([^']+)', \d+\)|(\S+):\d+): ")
+CONNECTED = re.compile(rb'New connection from (\S+):\d+$')
+CHUNK_SIZE = 4 * 1024 * 1024
+HEAD_SIZE = 128
+INDEX_VERSION = 3
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Server log analyzer')
+    parser.add_argument('directory', type=str,
+                        help='Directory with current and rotated logs')
+    parser.add_argument('--pattern', type=str, default='*.log*',
+                        help='File name pattern, plain, .zip and .gz files ' +
+                        'are read (default: *.log*)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Parallel worker processes (default: CPU count)')
+    parser.add_argument('--index', type=str, default=None,
+                        help='Index of already scanned files (default: ' +
+                        '.log_index.json in the log directory)')
+    parser.add_argument('--no-index', action='store_true',
+                        help='Scan everything and do not update the index')
+    parser.add_argument('--by', choices=['minute', 'hour', 'day'],
+                        default='hour',
+                        help='Time bucket of the rate table (default: hour)')
+    parser.add_argument('--since', type=str, default=None,
+                        help='Only count records from this time on, e.g. ' +
+                        '"2025-06-24 21:00"')
+    parser.add_argument('--until', type=str, default=None,
+                        help='Only count records before this time')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Clients to show (default: 10)')
+    parser.add_argument('--json', type=str,
+                        help='Write the aggregates to this JSON file')
+    return parser.parse_args()
+
+
+def setup_logging():
+    logger.remove()
+    logger.add(sys.stdout, level="INFO",
+               format="<cyan>{time:YYYY-MM-DD HH:mm:ss}</cyan> | <level>" +
+               "{level}</level> | {message}")
+    return logger
+
+
+def new_summary():
+    # minutes: минута -> [записей, принятых сообщений, {уровень: записей},
+    # {IP: [сообщений, байт сообщений, соединений]}]. Итоги по уровням и
+    # клиентам за выбранный период собирает select()
+    return {'minutes': {}}
+
+
+def scan(data, summary, start=0, end=None):
+    # Разбор без копирования: регулярное выражение работает прямо по
+    # mmap или куску архива. В цикле ключи остаются байтами, в строки
+    # они переводятся один раз в конце
+    end = len(data) if end is None else end
+    minutes = {}
+    for match in RECORD.finditer(data, start, end):
+        minute, level, message = match.groups()
+        bucket = minutes.get(minute)
+        if bucket is None:
+            bucket = minutes[minute] = [0, 0, {}, {}]
+        bucket[0] += 1
+        levels = bucket[2]
+        levels[level] = levels.get(level, 0) + 1
+
+        if message.startswith(b'Received from '):
+            received = RECEIVED.match(message)
+            if received is None:
+                continue
+            ip = received.group(1) or received.group(2)
+            client = bucket[3].get(ip)
+            if client is None:
+                client = bucket[3][ip] = [0, 0, 0]
+            client[0] += 1
+            client[1] += len(message) - received.end()
+            bucket[1] += 1
+        elif message.startswith(b'New connection from '):
+            connected = CONNECTED.match(message)
+            if connected is None:
+                continue
+            client = bucket[3].get(connected.group(1))
+            if client is None:
+                client = bucket[3][connected.group(1)] = [0, 0, 0]
+            client[2] += 1
+
+    merge(summary, {'minutes': {
+        minute.replace(b'T', b' ').decode('ascii'): [
+            records, messages,
+            {level.decode('ascii'): count for level, count in levels.items()},
+            {ip.decode('ascii', 'replace'): client
+             for ip, client in clients.items()}]
+        for minute, (records, messages, levels, clients) in minutes.items()
+    }})
+
+
+def scan_stream(stream, summary):
+    # Архив распаковывается потоком кусками по CHUNK_SIZE; неполная
+    # последняя строка куска переносится в следующий
+    tail = b''
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        data = tail + chunk
+        end = data.rfind(b'\n') + 1
+        scan(data, summary, 0, end)
+        tail = data[end:]
+    if tail:
+        scan(tail, summary)
+
+
+def scan_file(path, offset=0):
+    # Возвращает (сводка, смещение): для обычного файла - конец последней
+    # целой строки, с него продолжится следующий запуск
+    summary = new_summary()
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                with archive.open(name) as stream:
+                    scan_stream(stream, summary)
+        return summary, None
+    if path.endswith('.gz'):
+        with gzip.open(path) as stream:
+            scan_stream(stream, summary)
+        return summary, None
+
+    with open(path, 'rb') as log_file:
+        size = os.fstat(log_file.fileno()).st_size
+        if size <= offset:
+            return summary, offset
+        with mmap.mmap(log_file.fileno(), size,
+                       access=mmap.ACCESS_READ) as data:
+            end = data.rfind(b'\n', offset) + 1
+            if end > offset:
+                scan(data, summary, offset, end)
+                offset = end
+    return summary, offset
+
+
+def merge(total, summary):
+    into = total['minutes']
+    for minute, (records, messages, levels, clients) in \
+            summary['minutes'].items():
+        bucket = into.get(minute)
+        if bucket is None:
+            bucket = into[minute] = [0, 0, {}, {}]
+        bucket[0] += records
+        bucket[1] += messages
+        add_counts(bucket[2], bucket[3], levels, clients)
+    return total
+
+
+def add_counts(into_levels, into_clients, levels, clients):
+    for level, count in levels.items():
+        into_levels[level] = into_levels.get(level, 0) + count
+    for ip, values in clients.items():
+        current = into_clients.get(ip)
+        if current is None:
+            into_clients[ip] = list(values)
+        else:
+            for i, value in enumerate(values):
+                current[i] += value
+
+
+def file_identity(path):
+    # Устройство, inode, размер, время изменения и начало файла. Новый лог
+    # после ротации может получить inode удалённого, поэтому тот же ли это
+    # файл, проверяется и по первым байтам
+    info = os.stat(path)
+    with open(path, 'rb') as log_file:
+        head = log_file.read(HEAD_SIZE).decode('latin-1')
+    return [info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns, head]
+
+
+def load_index(path):
+    try:
+        with open(path, encoding='utf-8') as index_file:
+            index = json.load(index_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if index.get('version') != INDEX_VERSION:
+        return {}
+    return index['files']
+
+
+def save_index(path, files):
+    # Запись через временный файл: прерванный запуск не портит индекс
+    temporary = path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as index_file:
+        json.dump({'version': INDEX_VERSION, 'files': files}, index_file)
+    os.replace(temporary, path)
+
+
+def plan(paths, index):
+    # Что сканировать: архивы не меняются и берутся из индекса целиком;
+    # обычный лог дочитывается с сохранённого смещения, если это тот же
+    # файл (после ротации под тем же именем уже новый файл)
+    jobs = []
+    for path in paths:
+        name = os.path.basename(path)
+        entry = index.get(name)
+        identity = file_identity(path)
+        offset = 0
+        if entry is not None and entry['offset'] is None:
+            if entry['identity'] == identity:
+                continue
+            index.pop(name)
+        elif entry is not None:
+            if (entry['identity'][:2] == identity[:2] and
+                    identity[2] >= entry['offset'] and
+                    identity[4].startswith(entry['identity'][4])):
+                offset = entry['offset']
+            else:
+                index.pop(name)
+        jobs.append((path, offset))
+    return jobs
+
+
+def run_jobs(jobs, workers):
+    if workers <= 1 or len(jobs) <= 1:
+        return [scan_file(path, offset) for path, offset in jobs]
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        return list(pool.map(scan_file, *zip(*jobs)))
+
+
+def bucket_key(minute, by):
+    # "YYYY-MM-DD HH:MM" -> час или день
+    return {'minute': minute, 'hour': minute[:13], 'day': minute[:10]}[by]
+
+
+def select(total, since=None, until=None):
+    # Итоги за период: записи, уровни, клиенты и разбивка по минутам
+    # считаются только по минутам внутри [since, until). Точность - минута
+    selected = {'records': 0, 'levels': {}, 'minutes': {}, 'clients': {}}
+    for minute, (records, messages, levels, clients) in \
+            total['minutes'].items():
+        if ((since is not None and minute < since[:16]) or
+                (until is not None and minute >= until[:16])):
+            continue
+        selected['records'] += records
+        selected['minutes'][minute] = [records, messages]
+        add_counts(selected['levels'], selected['clients'], levels, clients)
+    return selected
+
+
+def report(total, by, top, log):
+    log.info(f"Records: {total['records']}; levels: " +
+             ", ".join(f"{level} {count}" for level, count in
+                       sorted(total['levels'].items(),
+                              key=lambda item: -item[1])))
+
+    clients = sorted(total['clients'].items(), key=lambda item: -item[1][0])
+    log.info(f"Clients: {len(clients)}, top {min(top, len(clients))} by " +
+             "messages:")
+    for ip, (messages, size, connections) in clients[:top]:
+        log.info(f"  {ip:<39} {messages:>10} messages {size:>12} bytes " +
+                 f"{connections:>8} connections")
+
+    buckets = {}
+    for minute, (records, messages) in total['minutes'].items():
+        counts = buckets.setdefault(bucket_key(minute, by), [0, 0, 0])
+        counts[0] += records
+        counts[1] += messages
+        counts[2] += 1
+    log.info(f"Per {by} (records, messages, messages/min over active " +
+             "minutes):")
+    for bucket in sorted(buckets):
+        records, messages, active = buckets[bucket]
+        log.info(f"  {bucket:<16} {records:>10} {messages:>10} " +
+                 f"{messages / active:>10.1f}")
+
+
+def main():
+    args = parse_args()
+    log = setup_logging()
+
+    paths = sorted(os.path.join(args.directory, name)
+                   for name in os.listdir(args.directory)
+                   if fnmatch.fnmatch(name, args.pattern) and
+                   not name.startswith('.') and
+                   os.path.isfile(os.path.join(args.directory, name)))
+    index_path = args.index or os.path.join(args.directory, '.log_index.json')
+    index = {} if args.no_index else load_index(index_path)
+    jobs = plan(paths, index)
+    log.info(f"{len(paths)} log files, {len(paths) - len(jobs)} from the " +
+             f"index, scanning {len(jobs)} with {args.jobs} processes " +
+             "(current logs from the last offset)")
+
+    for (path, offset), (summary, end) in zip(jobs,
+                                              run_jobs(jobs, args.jobs)):
+        name = os.path.basename(path)
+        entry = index.get(name)
+        if entry is not None and offset:
+            # Дочитанный хвост текущего лога
+            summary = merge(entry['summary'], summary)
+        index[name] = {'identity': file_identity(path), 'offset': end,
+                       'summary': summary}
+    # Файлы, удалённые из каталога, выпадают из индекса
+    names = {os.path.basename(path) for path in paths}
+    index = {name: entry for name, entry in index.items() if name in names}
+    if not args.no_index:
+        save_index(index_path, index)
+
+    total = new_summary()
+    for entry in index.values():
+        merge(total, entry['summary'])
+    total = select(total, args.since, args.until)
+    report(total, args.by, args.top, log)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(total, json_file, indent=2)
+        log.info(f"Aggregates written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
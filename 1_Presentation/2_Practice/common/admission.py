@@ -0,0 +1,120 @@
+# Допуск клиентов по адресу: ограничение частоты для отдельного IP и
+# для его подсети, а также числа одновременных соединений с одного IP.
+# Лишняя нагрузка отсекается до обработки: TCP-соединение закрывается
+# сразу после accept, UDP-датаграмма отбрасывается до разбора.
+import socket
+import time
+
+
+class RateLimiter:
+    # Token bucket в форме GCRA: на ключ хранится одно число - расчётное
+    # время следующего запроса (TAT). Ведро с burst запросов полностью
+    # восстанавливается за period секунд, поэтому запись, к которой не
+    # обращались дольше period, ничем не отличается от отсутствующей.
+    # Записи лежат в двух поколениях, которые меняются раз в period:
+    # старые адреса исчезают без обхода таблицы.
+
+    def __init__(self, rate, burst=None):
+        self.interval = 1.0 / rate
+        self.burst = burst or max(1, int(rate))
+        self.period = max((self.burst + 1) * self.interval, 1.0)
+        # Допуск с запасом в полинтервала против ошибок округления
+        self.tolerance = (self.burst - 0.5) * self.interval
+        self.current = {}
+        self.previous = {}
+        self.rotate_at = time.monotonic() + self.period
+
+    def allow(self, key, now):
+        if now >= self.rotate_at:
+            # Если простояли дольше периода, устарело и текущее поколение
+            stale = now - self.rotate_at >= self.period
+            self.previous = {} if stale else self.current
+            self.current = {}
+            self.rotate_at = now + self.period
+
+        tat = self.current.get(key)
+        if tat is None:
+            tat = self.previous.pop(key, now)
+        tat = max(tat, now)
+        if tat - now > self.tolerance:
+            self.current[key] = tat
+            return False
+        self.current[key] = tat + self.interval
+        return True
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+
+def address_keys(ip, ipv4_prefix=24, ipv6_prefix=64):
+    # Адрес и подсеть как целые числа: компактнее строк, и подсеть
+    # получается сдвигом. IPv6 смещён, чтобы не пересекаться с IPv4
+    if ':' in ip:
+        value = int.from_bytes(socket.inet_pton(socket.AF_INET6,
+                                                ip.split('%')[0]), 'big')
+        return value | 1 << 128, (value >> 128 - ipv6_prefix) | 1 << 128
+    value = int.from_bytes(socket.inet_aton(ip), 'big')
+    return value, value >> 32 - ipv4_prefix
+
+
+class Admission:
+    # rate/subnet_rate - запросов (соединений или датаграмм) в секунду,
+    # 0 - без ограничения; max_per_ip - одновременных соединений с IP
+
+    def __init__(self, rate=0, burst=None, subnet_rate=0, subnet_burst=None,
+                 max_per_ip=0, ipv4_prefix=24, ipv6_prefix=64):
+        self.ip_limiter = RateLimiter(rate, burst) if rate else None
+        self.subnet_limiter = (RateLimiter(subnet_rate, subnet_burst)
+                               if subnet_rate else None)
+        self.max_per_ip = max_per_ip
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.connections = {}
+        self.rejected = {'ip rate': 0, 'subnet rate': 0, 'ip connections': 0}
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return reason
+
+    def admit(self, ip, now=None):
+        # Возвращает причину отказа или None
+        ip_key, subnet_key = address_keys(ip, self.ipv4_prefix,
+                                          self.ipv6_prefix)
+        now = time.monotonic() if now is None else now
+        if (self.ip_limiter is not None and
+                not self.ip_limiter.allow(ip_key, now)):
+            return self._reject('ip rate')
+        if (self.subnet_limiter is not None and
+                not self.subnet_limiter.allow(subnet_key, now)):
+            return self._reject('subnet rate')
+        return None
+
+    def connect(self, ip):
+        # Для TCP: частота и число соединений; при успехе соединение
+        # учтено и должно быть закрыто через disconnect
+        reason = self.admit(ip)
+        if reason is not None or not self.max_per_ip:
+            return reason
+        count = self.connections.get(ip, 0)
+        if count >= self.max_per_ip:
+            return self._reject('ip connections')
+        self.connections[ip] = count + 1
+        return None
+
+    def disconnect(self, ip):
+        if not self.max_per_ip:
+            return
+        count = self.connections[ip] - 1
+        if count:
+            self.connections[ip] = count
+        else:
+            del self.connections[ip]
+
+    def summary(self):
+        tracked = sum(len(limiter) for limiter in (self.ip_limiter,
+                                                   self.subnet_limiter)
+                      if limiter is not None)
+        rejected = ", ".join(f"{count} over {reason}"
+                             for reason, count in self.rejected.items()
+                             if count)
+        return f"{rejected or 'nothing rejected'}; {tracked} tracked addresses"
@@ -0,0 +1,206 @@
+# Запись трафика сервера для последующего воспроизведения: события
+# соединений (открытие, принятое сообщение, ответ, закрытие) с временем
+# в наносекундах от начала записи. Файл только дописывается. Обработчики
+# добавляют событие в буфер в памяти, на диск его пишет фоновый поток;
+# если диск не успевает и оба буфера заполнены, события отбрасываются и
+# считаются. Каждый записанный блок начинается с заголовка запуска, так
+# что блоки двух процессов (перезапуск без простоя) не перепутаются.
+from collections import OrderedDict
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'GALACAP1'
+PROTOCOLS = ('tcp-raw', 'tcp-framed', 'udp')
+# Заголовок запуска: сигнатура, протокол, PID, время начала (нс с эпохи)
+RUN = struct.Struct('<8sBIQ')
+# Событие: тип, номер соединения, время от начала записи в нс
+EVENT = struct.Struct('<BIQ')
+# Принятое сообщение: событие, длина сообщения, длина сохранённой части
+DATA_EVENT = struct.Struct('<BIQII')
+OPEN, DATA, SENT, CLOSE = range(1, 5)
+
+
+class CaptureStream:
+    # События одного соединения (для UDP - одного адреса клиента)
+
+    __slots__ = ('capture', 'id')
+
+    def __init__(self, capture, stream_id):
+        self.capture = capture
+        self.id = stream_id
+
+    def received(self, payload, at=None):
+        # at - время приёма по time.perf_counter_ns(), если уже известно
+        self.capture.data(self.id, payload, at)
+
+    def sent(self):
+        self.capture.event(SENT, self.id)
+
+    def close(self):
+        self.capture.event(CLOSE, self.id)
+
+
+class TrafficCapture:
+    # Память ограничена двумя буферами по buffer_size байт: в один пишут
+    # обработчики, другой в это время записывается на диск, и max_peers
+    # адресами клиентов UDP
+
+    def __init__(self, path, protocol, buffer_size=1024 * 1024,
+                 payload=True, flush_interval=1.0, max_peers=4096):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.max_peers = max_peers
+        self.payload = payload
+        self.flush_interval = flush_interval
+        self.file = open(path, 'ab', buffering=0)
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.header = RUN.pack(MAGIC, PROTOCOLS.index(protocol), os.getpid(),
+                               time.time_ns())
+        self.pending = bytearray(self.header)
+        self.flushing = None
+        self.closed = False
+        self.next_id = 0
+        self.peers = OrderedDict()
+        self.events = self.dropped = self.written = 0
+        self.origin = time.perf_counter_ns()
+        self.thread = threading.Thread(target=self._run, name='capture',
+                                       daemon=True)
+        self.thread.start()
+
+    def open(self):
+        with self.lock:
+            stream_id = self.next_id
+            self.next_id += 1
+        self.event(OPEN, stream_id)
+        return CaptureStream(self, stream_id)
+
+    def stream(self, addr):
+        # Для UDP соединение - адрес клиента, открывается первой датаграммой.
+        # Дольше всех молчавший адрес сверх max_peers закрывается (LRU), его
+        # следующая датаграмма откроет новое соединение
+        peers = self.peers
+        stream = peers.get(addr)
+        if stream is not None:
+            peers.move_to_end(addr)
+            return stream
+        if len(peers) >= self.max_peers:
+            peers.popitem(last=False)[1].close()
+        stream = peers[addr] = self.open()
+        return stream
+
+    def event(self, kind, stream_id):
+        self._append(EVENT.pack(kind, stream_id,
+                                time.perf_counter_ns() - self.origin))
+
+    def data(self, stream_id, payload, at=None):
+        at = time.perf_counter_ns() if at is None else at
+        size = len(payload)
+        # Сообщение больше буфера не поместится никогда - сохраняем длину
+        stored = size if self.payload and size < self.buffer_size // 2 else 0
+        record = DATA_EVENT.pack(DATA, stream_id, at - self.origin, size,
+                                 stored)
+        self._append(record + payload if stored else record)
+
+    def _append(self, record):
+        with self.lock:
+            if len(self.pending) + len(record) > self.buffer_size:
+                if self.flushing is not None or self.closed:
+                    self.dropped += 1
+                    return
+                self._swap()
+            self.pending += record
+            self.events += 1
+
+    def _swap(self):
+        # Вызывается под self.lock
+        self.flushing, self.pending = self.pending, bytearray(self.header)
+        self.ready.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.flushing is None and not self.closed:
+                    # По таймауту пишется и неполный буфер, чтобы файл не
+                    # отставал при слабом трафике
+                    if (not self.ready.wait(self.flush_interval) and
+                            self.flushing is None and
+                            len(self.pending) > RUN.size):
+                        self._swap()
+                block, closed = self.flushing, self.closed
+            if block:
+                self._write(block)
+            with self.lock:
+                self.flushing = None
+            if closed:
+                break
+
+    def _write(self, block):
+        view = memoryview(block)
+        while view:
+            view = view[self.file.write(view):]
+        self.written += len(block)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.ready.notify()
+        self.thread.join()
+        # После остановки потока остался только текущий буфер
+        if len(self.pending) > RUN.size:
+            self._write(self.pending)
+        self.file.close()
+
+    def summary(self):
+        return (f"{self.events} events, {self.next_id} connections, " +
+                f"{self.written} bytes written to {self.path}, " +
+                f"{self.dropped} dropped")
+
+
+def read_runs(path):
+    # Разбор файла записи: список запусков в порядке начала, у каждого
+    # протокол, PID, время начала и события (тип, соединение, время нс,
+    # длина, данные или None)
+    with open(path, 'rb') as capture_file:
+        data = capture_file.read()
+    runs = {}
+    events = None
+    position = 0
+    while position < len(data):
+        if data[position] == MAGIC[0]:
+            magic, protocol, pid, started = RUN.unpack_from(data, position)
+            if magic != MAGIC:
+                raise ValueError(f"{path}: bad run header at {position}")
+            position += RUN.size
+            run = runs.get((started, pid))
+            if run is None:
+                run = runs[started, pid] = {
+                    'protocol': PROTOCOLS[protocol], 'pid': pid,
+                    'started': started, 'events': []}
+            events = run['events']
+            continue
+        if events is None:
+            raise ValueError(f"{path}: events before the first run header")
+        if len(data) - position < EVENT.size:
+            break  # Запись оборвана на середине события
+        kind = data[position]
+        if kind == DATA:
+            if len(data) - position < DATA_EVENT.size:
+                break
+            _, stream_id, at, size, stored = DATA_EVENT.unpack_from(
+                data, position)
+            position += DATA_EVENT.size
+            payload = data[position:position + stored] if stored else None
+            if payload is not None and len(payload) < stored:
+                break
+            position += stored
+        elif kind in (OPEN, SENT, CLOSE):
+            _, stream_id, at = EVENT.unpack_from(data, position)
+            position += EVENT.size
+            size, payload = 0, None
+        else:
+            raise ValueError(f"{path}: unknown event {kind} at {position}")
+        events.append((kind, stream_id, at, size, payload))
+    return [runs[key] for key in sorted(runs)]
@@ -0,0 +1,150 @@
+# Передача слушающего сокета новому процессу сервера без отказов в
+# подключении: либо новый процесс забирает дескриптор у старого через
+# Unix-сокет (SCM_RIGHTS), либо старый процесс по SIGHUP сам запускает
+# преемника и передаёт ему дескриптор по наследству (--listen-fd).
+import os
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import threading
+
+from unix_socket import remove_unix, socket_identity
+
+
+def handoff_supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds')
+
+
+def inherit_listener(listen_fd=None, handoff_path=None, log=None,
+                     timeout=5.0):
+    if listen_fd is not None:
+        listener = socket.socket(fileno=listen_fd)
+        if log is not None:
+            log.info(f"Using inherited listening socket fd {listen_fd}")
+        return listener
+    if handoff_path is None or not os.path.exists(handoff_path):
+        return None
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control:
+        control.settimeout(timeout)
+        try:
+            control.connect(handoff_path)
+            _, fds, _, _ = socket.recv_fds(control, 16, 1)
+        except (ConnectionRefusedError, FileNotFoundError, socket.timeout):
+            # Файл остался от упавшего процесса
+            return None
+    if not fds:
+        return None
+    if log is not None:
+        log.info(f"Took over listening socket via {handoff_path}")
+    return socket.socket(fileno=fds[0])
+
+
+class HandoffServer:
+    # Ждёт преемника на Unix-сокете, отдаёт ему слушающий дескриптор и
+    # вызывает on_handoff (остановить приём и дождаться клиентов)
+
+    def __init__(self, path, listener, on_handoff, log):
+        self.path = path
+        self.listener = listener
+        self.on_handoff = on_handoff
+        self.log = log
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise FileExistsError(f"{path} exists and is not a socket")
+            os.unlink(path)
+        self.control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.control.bind(path)
+        os.chmod(path, 0o600)  # Дескриптор отдаём только своему пользователю
+        self.control.listen(1)
+        self.identity = socket_identity(path)
+        threading.Thread(target=self._run, name='handoff',
+                         daemon=True).start()
+
+    def _run(self):
+        try:
+            connection, _ = self.control.accept()
+        except OSError:
+            return  # Сокет закрыт при обычной остановке
+        with connection:
+            socket.send_fds(connection, [b'LISTEN'], [self.listener.fileno()])
+        self.control.close()
+        self.log.info("Listening socket handed off to a new process")
+        self.on_handoff()
+
+    def close(self):
+        self.control.close()
+        remove_unix(self.path, self.identity)
+
+
+class GracefulShutdown:
+    # Плавная остановка по SIGTERM, SIGHUP или после передачи сокета:
+    # новые клиенты не принимаются, начатые обслуживаются не дольше
+    # drain_timeout секунд. С listener по SIGHUP сначала запускается
+    # преемник, без него SIGHUP - то же, что SIGTERM
+
+    def __init__(self, log, drain_timeout=30.0, listener=None):
+        self.log = log
+        self.drain_timeout = drain_timeout
+        self.listener = listener
+        self.requested = threading.Event()
+        self.callbacks = []
+        self.signalled = None
+        self.wakeup = threading.Event()
+
+    def install(self):
+        # Обработчик сигнала только будит поток: сигнал мог прервать
+        # основной поток внутри вызова loguru, а его блокировка не
+        # реентерабельна, так что лог и запуск преемника - в потоке
+        threading.Thread(target=self._on_wakeup, name='shutdown',
+                         daemon=True).start()
+        signal.signal(signal.SIGTERM, self._on_signal)
+        if hasattr(signal, 'SIGHUP'):  # Нет в Windows
+            signal.signal(signal.SIGHUP, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        if self.signalled is None:
+            self.signalled = signum
+            self.wakeup.set()
+
+    def _on_wakeup(self):
+        self.wakeup.wait()
+        signum = self.signalled
+        if self.requested.is_set():
+            return
+        if (signum == getattr(signal, 'SIGHUP', None) and
+                self.listener is not None):
+            spawn_successor(self.listener, self.log)
+        self.request(f"Received {signal.Signals(signum).name}")
+
+    def on_request(self, callback):
+        self.callbacks.append(callback)
+
+    def request(self, reason):
+        if self.requested.is_set():
+            return
+        self.requested.set()
+        self.log.info(f"{reason}: no longer accepting, draining clients " +
+                      f"for up to {self.drain_timeout:g}s")
+        for callback in self.callbacks:
+            callback()
+
+
+def spawn_successor(listener, log):
+    # Тот же скрипт с теми же аргументами, но с унаследованным сокетом
+    argv = []
+    skip = False
+    for arg in sys.argv:
+        if skip:
+            skip = False
+        elif arg == '--listen-fd':
+            skip = True
+        elif not arg.startswith('--listen-fd='):
+            argv.append(arg)
+    fd = listener.fileno()
+    process = subprocess.Popen([sys.executable] + argv +
+                               ['--listen-fd', str(fd)], pass_fds=[fd])
+    log.info(f"Started successor process {process.pid}")
+    return process
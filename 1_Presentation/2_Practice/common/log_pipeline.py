@@ -0,0 +1,131 @@
+# Неблокирующее логирование для серверов: записи передаются фоновому
+# потоку через ограниченную очередь, а форматирование, запись на диск,
+# ротация и сжатие выполняются уже в нём.
+import atexit
+import copy
+import queue
+import threading
+import time
+
+_STOP = object()
+
+
+class BackgroundWriter:
+    # Обработчики (stdout, файл) добавляются в self.logger - копию
+    # основного логгера, которую использует только фоновый поток.
+    # Основной логгер лишь кладёт запись в очередь и никогда не ждёт.
+
+    def __init__(self, logger, maxsize=10000, report_interval=10.0):
+        self.main = logger
+        self.logger = copy.deepcopy(logger)
+        self.queue = queue.Queue(maxsize)
+        self.report_interval = report_interval
+        self.dropped = 0
+        self.handler_id = None
+        self.thread = threading.Thread(target=self._run, name='log-writer',
+                                       daemon=True)
+
+    def start(self, level='DEBUG'):
+        self.thread.start()
+        self.handler_id = self.main.add(self._enqueue, level=level,
+                                        format='{message}', catch=False)
+        atexit.register(self.stop)
+
+    def _enqueue(self, message):
+        try:
+            self.queue.put_nowait(message.record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, record):
+        # Запись повторяется в копии логгера с исходными временем, уровнем
+        # и местом вызова
+        self.logger.patch(lambda r: r.update(record)).log(
+            record['level'].name, '')
+
+    def _run(self):
+        report_at = time.monotonic() + self.report_interval
+        while True:
+            try:
+                record = self.queue.get(timeout=self.report_interval)
+            except queue.Empty:
+                record = None
+            if record is _STOP:
+                break
+            if record is not None:
+                self._write(record)
+
+            if self.dropped and time.monotonic() >= report_at:
+                dropped, self.dropped = self.dropped, 0
+                self.logger.warning(f"Log queue full, dropped {dropped} " +
+                                    "records")
+                report_at = time.monotonic() + self.report_interval
+
+    def stop(self):
+        if self.handler_id is None:
+            return
+        self.main.remove(self.handler_id)
+        self.handler_id = None
+        self.queue.put(_STOP)
+        self.thread.join()
+        if self.dropped:
+            self.logger.warning(f"Log queue full, dropped {self.dropped} " +
+                                "records")
+        self.logger.remove()
+
+
+class SampledLogger:
+    # Для записей о каждом сообщении: в лог попадает только каждая rate-я
+    # запись с одним и тем же шаблоном, раз в interval секунд пишется
+    # сводка.
+    # Аргументы форматируются лениво (стиль loguru "{}"), поэтому
+    # пропущенные записи ничего не стоят.
+
+    def __init__(self, log, rate=1, interval=10.0):
+        self.log = log
+        self.rate = rate
+        self.interval = interval
+        self.seen = {}
+        self.skipped = 0
+        self.summary_at = time.monotonic() + interval
+
+    def _log(self, level, message, args):
+        seen = self.seen.get(message, 0) + 1
+        self.seen[message] = seen
+        if seen % self.rate:
+            self.skipped += 1
+        else:
+            self.log.opt(depth=2).log(level, message, *args)
+
+        now = time.monotonic()
+        if now >= self.summary_at:
+            total = sum(self.seen.values())
+            self.log.info(f"Per-message log: {total} records in last " +
+                          f"{self.interval:g}s, {self.skipped} sampled out")
+            self.seen.clear()
+            self.skipped = 0
+            self.summary_at = now + self.interval
+
+    def info(self, message, *args):
+        self._log('INFO', message, args)
+
+    def debug(self, message, *args):
+        self._log('DEBUG', message, args)
+
+
+def sample_messages(log, rate):
+    if rate <= 1:
+        return log
+    return SampledLogger(log, rate)
+
+
+class LazyText:
+    # Байты декодируются в текст только если запись действительно
+    # форматируется (уровень включён и запись не отброшена сэмплингом)
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return str(self.data, 'utf-8', 'replace')
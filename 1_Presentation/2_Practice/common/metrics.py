@@ -0,0 +1,200 @@
+# Метрики серверов: счётчики, гистограммы с фиксированными корзинами,
+# HTTP-эндпоинт в текстовом формате Prometheus и периодическая сводка в
+# лог. Каждый поток пишет только в свою ячейку, поэтому горячий путь
+# обходится без блокировок; ячейки суммируются при чтении.
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+# Время обслуживания запроса, секунды
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+    def _new_cell(self):
+        cell = [0]
+        with self._lock:
+            self._cells.append(cell)
+        self._local.cell = cell
+        return cell
+
+    def inc(self, amount=1):
+        try:
+            self._local.cell[0] += amount
+        except AttributeError:
+            self._new_cell()[0] += amount
+
+    @property
+    def value(self):
+        return sum(cell[0] for cell in self._cells)
+
+    def render(self):
+        return [f"{self.name} {self.value}"]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+    def _new_cell(self):
+        # Корзины, затем +Inf и сумма наблюдений
+        cell = [0] * (len(self.buckets) + 1) + [0.0]
+        with self._lock:
+            self._cells.append(cell)
+        self._local.cell = cell
+        return cell
+
+    def observe(self, value):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._new_cell()
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def snapshot(self):
+        totals = [0] * (len(self.buckets) + 2)
+        for cell in self._cells:
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+    def render(self):
+        totals = self.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), totals):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {totals[-1]}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+def quantile(buckets, counts, q):
+    # Оценка квантиля по корзинам: верхняя граница корзины
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return float('inf')
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self._register(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def start_http_exporter(registry, host, port, log):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Не засоряем лог сервера запросами к метрикам
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http',
+                     daemon=True).start()
+    log.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
+
+
+def start_reporter(registry, interval, log):
+    # Раз в interval секунд: скорость счётчиков, значения gauge и p50/p99
+    # гистограмм за прошедший интервал
+    def run():
+        previous = {}
+        while True:
+            time.sleep(interval)
+            parts = []
+            for metric in registry.metrics:
+                if metric.kind == 'gauge':
+                    parts.append(f"{metric.name} {metric.value}")
+                elif metric.kind == 'counter':
+                    value = metric.value
+                    rate = (value - previous.get(metric.name, 0)) / interval
+                    previous[metric.name] = value
+                    parts.append(f"{metric.name} {rate:.1f}/s")
+                else:
+                    totals = metric.snapshot()[:-1]
+                    last = previous.get(metric.name, [0] * len(totals))
+                    previous[metric.name] = totals
+                    counts = [now - before
+                              for now, before in zip(totals, last)]
+                    buckets = metric.buckets + (float('inf'),)
+                    p50 = quantile(buckets, counts, 0.5) * 1000
+                    p99 = quantile(buckets, counts, 0.99) * 1000
+                    parts.append(f"{metric.name} p50<={p50:g}ms " +
+                                 f"p99<={p99:g}ms")
+            log.info("Metrics: " + ", ".join(parts))
+
+    threading.Thread(target=run, name='metrics-reporter', daemon=True).start()
+
+
+def serve_metrics(registry, log, host='127.0.0.1', port=None, interval=0):
+    if port:
+        start_http_exporter(registry, host, port, log)
+    if interval:
+        start_reporter(registry, interval, log)
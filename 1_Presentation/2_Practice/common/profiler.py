@@ -0,0 +1,243 @@
+# Профилирование горячего пути работающего сервера без перезапуска:
+# SIGUSR1 включает замер, повторный SIGUSR1 выключает его и пишет в лог
+# разбивку времени по стадиям обработки сообщения. Замеряется каждое
+# sample-е сообщение, выключенный профайлер стоит одной проверки на
+# сообщение. Дополнительно можно снять cProfile (файл .prof для pstats
+# или snakeviz) или сэмплы стеков (файл .folded для flamegraph.pl или
+# speedscope).
+import cProfile
+from collections import Counter
+import marshal
+import os
+import signal
+import sys
+import threading
+import time
+
+MODES = ('stages', 'cprofile', 'stacks')
+
+
+class Probe:
+    # Время от предыдущей отметки (или от создания) до mark(stage)
+
+    __slots__ = ('stages', 'last')
+
+    def __init__(self):
+        self.stages = []
+        self.last = time.perf_counter_ns()
+
+    def mark(self, stage):
+        now = time.perf_counter_ns()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+
+class StackSampler:
+    # Раз в interval секунд снимает стеки всех потоков, кроме своего, и
+    # считает одинаковые стеки в формате folded: "поток;файл:функция;..."
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='stack-sampler',
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name
+                     for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:" +
+                                 code.co_name)
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, 'w') as output:
+            for stack, count in self.stacks.most_common():
+                output.write(f"{stack} {count}\n")
+
+
+class StageProfiler:
+    # Обработчик берёт probe() на каждое сообщение и, если получил Probe,
+    # отмечает стадии и отдаёт его в record(). Обработчик сигнала только
+    # будит поток управления: сигнал может прийти, пока основной поток
+    # держит блокировку лога или модуля threading, поэтому запуск и
+    # остановка замера, лог и запись файлов - в этом потоке
+
+    def __init__(self, log, sample=100, mode='stages', output='profile',
+                 interval=0.005):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiler mode {mode}")
+        self.log = log
+        self.sample = sample
+        self.mode = mode
+        self.output = output
+        self.interval = interval
+        # running - замер включён сигналом; active - обслуживающий поток
+        # берёт пробы (для cProfile выключается с его выключением)
+        self.running = False
+        self.active = False
+        self.countdown = sample
+        self.runs = 0
+        self.extra = None
+        # cProfile замеряет только поток, который его включил, поэтому
+        # включает и выключает его сам обслуживающий поток в probe():
+        # switch - None, ('enable', профайлер) или ('disable', None);
+        # installed - профайлер, включённый в обслуживающем потоке
+        self.switch = None
+        self.installed = None
+        self.switched = threading.Event()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def install(self):
+        if not hasattr(signal, 'SIGUSR1'):  # Нет в Windows
+            return False
+        threading.Thread(target=self._control, name='profiler',
+                         daemon=True).start()
+        signal.signal(signal.SIGUSR1, self._on_signal)
+        return True
+
+    def _on_signal(self, signum, frame):
+        self.wakeup.set()
+
+    def _control(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.running:
+                self.stop()
+            else:
+                self.start()
+
+    def probe(self):
+        if not self.active:
+            return None
+        if self.switch is not None:
+            self._switch()
+            if not self.active:
+                return None
+        self.countdown -= 1
+        if self.countdown:
+            return None
+        self.countdown = self.sample
+        return Probe()
+
+    def record(self, probe):
+        if not self.active:
+            return  # Выключили, пока сообщение обрабатывалось
+        self.messages += 1
+        totals = self.totals
+        for stage, elapsed in probe.stages:
+            entry = totals.get(stage)
+            if entry is None:
+                totals[stage] = [elapsed, elapsed]
+            else:
+                entry[0] += elapsed
+                if elapsed > entry[1]:
+                    entry[1] = elapsed
+
+    def _switch(self):
+        with self.lock:
+            action, profile = self.switch
+            self.switch = None
+            if self.installed is not None:
+                self.installed.disable()
+                self.installed = None
+            if action == 'enable':
+                profile.enable()
+                self.installed = profile
+            else:
+                self.active = False
+        self.switched.set()
+
+    def start(self):
+        # Стадия -> [сумма нс, максимум нс]; порядок вставки совпадает с
+        # порядком стадий
+        self.totals = {}
+        self.messages = 0
+        self.started_at = time.monotonic()
+        self.runs += 1
+        if self.mode == 'cprofile':
+            self.extra = cProfile.Profile()
+            # Заменяет невыполненное выключение прошлого замера: _switch
+            # выключит его профайлер перед включением нового
+            with self.lock:
+                self.switch = ('enable', self.extra)
+        elif self.mode == 'stacks':
+            self.extra = StackSampler(self.interval)
+            self.extra.start()
+        self.countdown = self.sample
+        self.running = self.active = True
+        self.log.info(f"Profiling started (mode {self.mode}, 1 in " +
+                      f"{self.sample} messages), send SIGUSR1 again to stop")
+
+    def stop(self):
+        self.running = False
+        if self.mode == 'cprofile':
+            with self.lock:
+                waiting = self.switch is None
+                if waiting:
+                    self.switched.clear()
+                    self.switch = ('disable', None)
+                else:
+                    # Сообщений не было, cProfile так и не включился
+                    self.switch = None
+                    self.active = False
+            # Простаивающий сервер выключит cProfile со следующим
+            # сообщением, а отчёт пишется сейчас
+            if waiting:
+                self.switched.wait(1.0)
+        else:
+            self.active = False
+        # Копия: основной поток мог остановиться посреди record()
+        totals = {stage: list(entry) for stage, entry in self.totals.items()}
+        extra, self.extra = self.extra, None
+        self._report(totals, self.messages,
+                     time.monotonic() - self.started_at, extra, self.runs)
+
+    def _report(self, totals, messages, duration, extra, run):
+        log = self.log
+        log.info(f"Profile of {messages} sampled messages over " +
+                 f"{duration:.1f}s:")
+        total = sum(entry[0] for entry in totals.values()) or 1
+        # Стадия может встречаться в сообщении несколько раз (лог до и
+        # после отправки), поэтому среднее - на сообщение, а не на замер
+        for stage, (elapsed, longest) in totals.items():
+            log.info(f"  {stage:<8} {elapsed / messages / 1000:9.1f} us per " +
+                     f"message {elapsed / total * 100:5.1f}%, max " +
+                     f"{longest / 1000:.1f} us")
+        if messages:
+            log.info(f"  {'total':<8} {total / messages / 1000:9.1f} us per " +
+                     "message")
+
+        if self.mode == 'cprofile':
+            path = f"{self.output}.{os.getpid()}.{run}.prof"
+            # Как dump_stats, но без disable(): выключать cProfile может
+            # только профилируемый поток
+            extra.snapshot_stats()
+            with open(path, 'wb') as output:
+                marshal.dump(extra.stats, output)
+            log.info(f"cProfile stats written to {path}")
+        elif self.mode == 'stacks':
+            extra.stop()
+            path = f"{self.output}.{os.getpid()}.{run}.folded"
+            extra.dump(path)
+            log.info(f"{sum(extra.stacks.values())} stack samples written " +
+                     f"to {path}")
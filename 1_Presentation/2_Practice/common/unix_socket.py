@@ -0,0 +1,106 @@
+# Unix-сокеты для клиентов на том же хосте: без стека TCP/IP и с правами
+# доступа файловой системы. Файл сокета остаётся на диске после падения
+# процесса; такой файл удаляется, а живой сокет другого сервера - нет.
+import os
+import socket
+import stat
+
+
+def unix_supported():
+    return hasattr(socket, 'AF_UNIX')
+
+
+def peer_name(path):
+    # Имя клиента в логах: адрес вида "unix:/путь", как у IP-клиентов
+    return f"unix:{path or '-'}"
+
+
+def is_live(path, kind):
+    # Файл живой, если к нему можно подключиться (для датаграммного
+    # сокета connect только проверяет, что адресат существует)
+    with socket.socket(socket.AF_UNIX, kind) as probe:
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+        except OSError:
+            return True  # Например, нет прав - считаем, что файл занят
+    return True
+
+
+def bind_unix(sock, path, mode=0o660, replace=False, backlog=None):
+    # Привязывает sock к path и возвращает отметку файла для remove_unix.
+    # Сокет появляется под path уже готовым: привязка к временному имени,
+    # listen и атомарное переименование. replace - при перезапуске без
+    # простоя: новый сокет подменяет файл старого процесса, который
+    # дообслуживает своих клиентов
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise FileExistsError(f"{path} exists and is not a socket")
+        if not replace:
+            if is_live(path, sock.type):
+                raise OSError(f"{path} is in use by another process")
+            os.unlink(path)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    if os.path.lexists(temporary):
+        os.unlink(temporary)
+    # Права задаются уже при создании файла, без окна с правами по umask
+    umask = os.umask(0o777 & ~mode)
+    try:
+        sock.bind(temporary)
+    finally:
+        os.umask(umask)
+    try:
+        os.chmod(temporary, mode)
+        if backlog is not None:
+            sock.listen(backlog)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return socket_identity(path)
+
+
+def socket_identity(path):
+    # Номер inode может достаться новому файлу, поэтому сравниваем и
+    # время создания
+    info = os.stat(path)
+    return info.st_dev, info.st_ino, info.st_ctime_ns
+
+
+def remove_unix(path, identity):
+    # Файл мог уже занять преемник - удаляем только свой
+    try:
+        if socket_identity(path) == identity:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class UnixEndpoint:
+    # Слушающий (SOCK_STREAM) или принимающий датаграммы (SOCK_DGRAM)
+    # Unix-сокет сервера вместе с путём, по которому он доступен
+
+    def __init__(self, path, kind=socket.SOCK_STREAM, mode=0o660,
+                 backlog=socket.SOMAXCONN, replace=False):
+        self.path = path
+        self.name = peer_name(path)
+        self.socket = socket.socket(socket.AF_UNIX, kind)
+        try:
+            self.identity = bind_unix(
+                self.socket, path, mode, replace,
+                backlog if kind == socket.SOCK_STREAM else None)
+        except BaseException:
+            self.socket.close()
+            raise
+        self.accepted = 0
+
+    def client_addr(self):
+        # У клиентов потокового Unix-сокета нет адреса, в логах они
+        # различаются номером соединения
+        self.accepted += 1
+        return self.name, self.accepted
+
+    def close(self):
+        self.socket.close()
+        remove_unix(self.path, self.identity)
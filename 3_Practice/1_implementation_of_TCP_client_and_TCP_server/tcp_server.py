@@ -1,8 +1,18 @@
 import argparse
+import os
+import signal
 import socket
+import time
 from loguru import logger
 import sys
 
+# Перезапуск упавшего воркера: задержка удваивается от RESTART_DELAY до
+# MAX_RESTART_DELAY; воркер, проработавший STABLE_AFTER секунд, считается
+# здоровым, и счётчик падений сбрасывается
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+STABLE_AFTER = 60.0
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='TCP server')
@@ -15,7 +25,18 @@ def parse_args():
                         'nd_TCP_server/server.log',
                         help='Log file path (default: 3_Practice/1_implement' +
                         'ation_of_TCP_client_and_TCP_server/server.log)')
-    return parser.parse_args()
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes (default: 1)')
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help='Seconds to wait for workers on shutdown ' +
+                        '(default: 30.0)')
+    parser.add_argument('--max-restarts', type=int, default=5,
+                        help='Restarts in a row of a crashing worker ' +
+                        'before giving up on it (default: 5)')
+    args = parser.parse_args()
+    if args.workers > 1 and not hasattr(os, 'fork'):
+        parser.error('--workers requires os.fork (Linux/macOS)')
+    return args
 
 
 def setup_logging(log_file):
@@ -27,12 +48,39 @@ def setup_logging(log_file):
     return logger
 
 
-def start_server(host, port, log):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+def create_server_socket(host, port, reuse_port=False):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT,
+                                     1)
         server_socket.bind((host, port))
         server_socket.listen(5)
+    except OSError:
+        server_socket.close()
+        raise
+    return server_socket
+
+
+def handle_client(client_socket, addr, log):
+    with client_socket:
+        while True:
+            data = client_socket.recv(1024)
+            if not data:
+                log.debug(f"Client {addr} disconnected")
+                break
+
+            message = data.decode('utf-8')
+            log.info(f"Received from {addr}:{message}")
 
+            response = f"ECHO: {message}"
+            client_socket.sendall(response.encode('utf-8'))
+            log.debug(f"Sent responce to {addr}")
+
+
+def start_server(host, port, log):
+    with create_server_socket(host, port) as server_socket:
         log.info(f"Server started on {host}:{port}. Waiting for connections..."
                  )
 
@@ -40,25 +88,180 @@ def start_server(host, port, log):
             while True:
                 client_socket, addr = server_socket.accept()
                 log.info(f"New connection from {addr[0]}:{addr[1]}")
+                handle_client(client_socket, addr, log)
+        except KeyboardInterrupt:
+            log.info("Server shutdown by administrator")
 
-                with client_socket:
-                    while True:
-                        data = client_socket.recv(1024)
-                        if not data:
-                            log.debug(f"Client {addr} disconnected")
-                            break
 
-                        message = data.decode('utf-8')
-                        log.info(f"Received from {addr}:{message}")
+def supports_reuse_port():
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        return False
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        try:
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        except OSError:
+            return False
+    return True
 
-                        response = f"ECHO: {message}"
-                        client_socket.sendall(response.encode('utf-8'))
-                        log.debug(f"Sent responce to {addr}")
-        except KeyboardInterrupt:
-            log.info("Server shutdown by administrator")
+
+def run_worker(server_socket, log):
+    stopping = False
+
+    def on_sigterm(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    # Ctrl+C получает супервизор, он же останавливает воркеры
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Таймаут accept нужен, чтобы периодически проверять флаг остановки;
+    # текущий клиент при этом обслуживается до конца
+    server_socket.settimeout(1.0)
+    log.info(f"Worker {os.getpid()} is accepting connections")
+    while not stopping:
+        try:
+            client_socket, addr = server_socket.accept()
+        except socket.timeout:
+            continue
+        client_socket.settimeout(None)
+        log.info(f"New connection from {addr[0]}:{addr[1]}")
+        try:
+            handle_client(client_socket, addr, log)
+        except (ConnectionError, UnicodeDecodeError) as e:
+            log.error(f"Client {addr} error: {e}")
+    server_socket.close()
+    log.info(f"Worker {os.getpid()} stopped")
+
+
+def worker_log(log_file, index):
+    # У каждого воркера свой файл: процессы не делят ротацию одного файла
+    root, ext = os.path.splitext(log_file)
+    return f"{root}.worker{index}{ext}"
+
+
+def spawn_worker(host, port, shared_socket, log_file, index):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    code = 0
+    log = setup_logging(worker_log(log_file, index))
+    try:
+        if shared_socket is None:
+            # Каждый воркер слушает свой сокет, ядро само распределяет
+            # подключения между ними (SO_REUSEPORT)
+            server_socket = create_server_socket(host, port, reuse_port=True)
+        else:
+            server_socket = shared_socket
+        run_worker(server_socket, log)
+    except Exception as e:
+        log.error(f"Worker {os.getpid()} crashed: {e}")
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def stop_workers(workers, drain_timeout, log):
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.monotonic() + drain_timeout
+    while workers and time.monotonic() < deadline:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            workers.discard(pid)
+        else:
+            time.sleep(0.1)
+
+    for pid in workers:
+        log.warning(f"Worker {pid} did not drain in {drain_timeout}s, " +
+                    "killing")
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+def start_workers(host, port, workers, log, log_file, drain_timeout=30.0,
+                  max_restarts=5):
+    shared_socket = None
+    if supports_reuse_port():
+        log.info(f"Starting {workers} workers on {host}:{port} " +
+                 "with SO_REUSEPORT")
+    else:
+        # Запасной вариант: один слушающий сокет, унаследованный воркерами
+        shared_socket = create_server_socket(host, port)
+        log.info(f"Starting {workers} workers on {host}:{port} " +
+                 "with a shared listening socket")
+
+    stopping = False
+
+    def on_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    # pid -> (номер воркера, время запуска); номер воркера -> время
+    # отложенного перезапуска
+    pids = {}
+    restarts = {}
+    failures = [0] * workers
+    for index in range(workers):
+        pid = spawn_worker(host, port, shared_socket, log_file, index)
+        pids[pid] = (index, time.monotonic())
+    try:
+        while not stopping:
+            time.sleep(0.5)
+            now = time.monotonic()
+            while pids:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                index, started = pids.pop(pid)
+                if stopping:
+                    break
+                code = os.waitstatus_to_exitcode(status)
+                if now - started >= STABLE_AFTER:
+                    failures[index] = 0
+                failures[index] += 1
+                if failures[index] > max_restarts:
+                    log.error(f"Worker {pid} exited with status {code}, " +
+                              f"giving up after {max_restarts} restarts")
+                    continue
+                delay = min(RESTART_DELAY * 2 ** (failures[index] - 1),
+                            MAX_RESTART_DELAY)
+                log.error(f"Worker {pid} exited with status {code}, " +
+                          f"restarting in {delay:g}s")
+                restarts[index] = now + delay
+            for index, due in list(restarts.items()):
+                if due <= now and not stopping:
+                    del restarts[index]
+                    pid = spawn_worker(host, port, shared_socket, log_file,
+                                       index)
+                    pids[pid] = (index, time.monotonic())
+            if not pids and not restarts:
+                log.error("All workers failed, stopping the server")
+                return False
+        log.info("Server shutdown by administrator, draining workers")
+        stop_workers(set(pids), drain_timeout, log)
+    finally:
+        if shared_socket is not None:
+            shared_socket.close()
+    log.info("All workers stopped")
+    return True
 
 
 if __name__ == '__main__':
     args = parse_args()
     log = setup_logging(args.log)
-    start_server(args.host, args.port, log)
+    if args.workers > 1:
+        if not start_workers(args.host, args.port, args.workers, log,
+                             args.log, args.drain_timeout,
+                             args.max_restarts):
+            sys.exit(1)
+    else:
+        start_server(args.host, args.port, log)